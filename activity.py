@@ -0,0 +1,117 @@
+from collections import Counter, deque
+from datetime import datetime
+from threading import Lock
+import logging
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+
+class ActivityTracker:
+    """Buffers the commands handled per user and the charts requested per place in memory
+    and aggregates them on flush().
+
+    Aggregated per-day statistics and chart request counts are stored in a SQLite database,
+    so they can be queried without loading any user data.
+    """
+
+    def __init__(self):
+        self._buffer = deque()
+        self._charts = deque()
+        self._chart_counts = Counter()
+        self._connection = None
+        self._lock = Lock()
+
+    def connect(self, filename):
+        self._connection = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS daily_users (day TEXT, user_id INTEGER, count INTEGER, PRIMARY KEY (day, user_id));
+            CREATE TABLE IF NOT EXISTS daily_commands (day TEXT, command TEXT, count INTEGER, PRIMARY KEY (day, command));
+            CREATE TABLE IF NOT EXISTS chart_requests (code TEXT PRIMARY KEY, count INTEGER);
+        """)
+        with self._lock:
+            self._chart_counts.update(dict(self._connection.execute("SELECT code, count FROM chart_requests")))
+
+    def record(self, user_id, command, timestamp):
+        # appending to a deque is thread-safe, so no lock is needed on the request path
+        self._buffer.append((user_id, command, timestamp))
+
+    def record_chart(self, code):
+        self._charts.append(code)
+
+    def chart_requests(self):
+        """Returns the number of charts requested per place up to the last flush."""
+        with self._lock:
+            return Counter(self._chart_counts)
+
+    def _flush_charts(self):
+        charts = Counter()
+        while self._charts:
+            charts[self._charts.popleft()] += 1
+        if not charts:
+            return
+        self._chart_counts.update(charts)
+        if self._connection:
+            try:
+                with self._connection:
+                    self._connection.executemany(
+                        "INSERT INTO chart_requests VALUES (?, ?) "
+                        "ON CONFLICT (code) DO UPDATE SET count = count + excluded.count",
+                        list(charts.items()),
+                    )
+            except sqlite3.Error:
+                logger.warning("Failed to write chart requests.", exc_info=True)
+
+    def flush(self, dispatcher):
+        """Aggregates all buffered activity into the user data and the daily statistics."""
+        with self._lock:
+            self._flush_charts()
+            records = []
+            while self._buffer:
+                records.append(self._buffer.popleft())
+            if not records:
+                return
+            users, daily_users, daily_commands = {}, Counter(), Counter()
+            for user_id, command, timestamp in records:
+                first, last, count = users.get(user_id, (timestamp, timestamp, 0))
+                users[user_id] = (min(first, timestamp), max(last, timestamp), count + 1)
+                day = datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%d")
+                daily_users[(day, user_id)] += 1
+                daily_commands[(day, command)] += 1
+            for user_id, (first, last, count) in users.items():
+                user_data = dispatcher.user_data[user_id]
+                user_data.setdefault('first_acc', first)
+                user_data['last_acc'] = last
+                user_data['count'] = user_data.get('count', 0) + count
+                if dispatcher.persistence:
+                    dispatcher.persistence.update_user_data(user_id, user_data)
+            if self._connection:
+                try:
+                    with self._connection:
+                        self._connection.executemany(
+                            "INSERT INTO daily_users VALUES (?, ?, ?) "
+                            "ON CONFLICT (day, user_id) DO UPDATE SET count = count + excluded.count",
+                            [(day, user_id, count) for (day, user_id), count in daily_users.items()],
+                        )
+                        self._connection.executemany(
+                            "INSERT INTO daily_commands VALUES (?, ?, ?) "
+                            "ON CONFLICT (day, command) DO UPDATE SET count = count + excluded.count",
+                            [(day, command, count) for (day, command), count in daily_commands.items()],
+                        )
+                except sqlite3.Error:
+                    logger.warning("Failed to write activity statistics.", exc_info=True)
+
+    def daily_active_users(self, day=None):
+        """Returns the number of users active on the given day (as "YYYY-MM-DD"), by default today."""
+        if not self._connection:
+            return 0
+        day = day or datetime.utcnow().strftime("%Y-%m-%d")
+        return self._connection.execute("SELECT COUNT(*) FROM daily_users WHERE day = ?", (day,)).fetchone()[0]
+
+    def command_counts(self, day=None):
+        """Returns the number of times each command was used on the given day, by default today."""
+        if not self._connection:
+            return {}
+        day = day or datetime.utcnow().strftime("%Y-%m-%d")
+        rows = self._connection.execute("SELECT command, count FROM daily_commands WHERE day = ?", (day,))
+        return dict(rows)
@@ -1,24 +1,36 @@
 #!/usr/bin/env python3
 from datetime import datetime
+import io
 import json
 import logging
 import math
-import re
-from time import sleep
+import os
 
 from telegram import ParseMode
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
 from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, MessageHandler, Filters, InlineQueryHandler
-from telegram.ext import PicklePersistence, ConversationHandler
-from telegram.error import TelegramError
-
-from statistics_api import CovidApi
+from telegram.ext import ConversationHandler, MessageFilter
+from telegram.error import BadRequest, TelegramError
+
+from statistics_api import CovidApi, SORT_ORDERS
+from history import HistoryStore
+from search import PrefixIndex, NameResolver, normalize
+from persistence import SqlitePersistence
+from broadcast import Broadcaster
+from cache import LRUCache
 import wikidata
-from resources.resolver import resolve
+from resources.resolver import resolve, language
 from utils import *
-from plot import plot_timeseries, plot_vaccinations_series
+from plot import render_chart, data_version, RenderService, RenderError
 
 CONFIG_FILE="config.json"
+HISTORY_DIR="history"
+METADATA_FILE="metadata.json"
+LABELS_FILE="labels.json"
+MAPS_FILE="maps.json"
+DATABASE_FILE="database.sqlite"
+# the database file of the previously used PicklePersistence, migrated on first start
+LEGACY_DATABASE_FILE="database.pkl"
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
@@ -26,8 +38,33 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
 logger = logging.getLogger(__name__)
 
 WORLD_IDENT="world"
-
-api = CovidApi()
+# default interval (in seconds) in which all data is refreshed in the background
+REFRESH_INTERVAL=10*60
+# default number of most requested countries for which charts are rendered after each refresh
+PRERENDER_COUNT=20
+# interval (in seconds) in which user activity is aggregated and changed data is written to the database
+FLUSH_INTERVAL=60
+# delay (in seconds) after which a broadcast left unfinished because of the flood limit is retried
+BROADCAST_RETRY_DELAY=10*60
+# default number of processes rendering charts
+RENDER_WORKERS=2
+# number of formatted stats texts kept in memory
+TEXT_CACHE_SIZE=1024
+
+# the chart renderer and the api, created on startup, as render workers import this module
+renderer = None
+api = None
+
+wikidata.load_maps(MAPS_FILE)
+
+# sends the daily notifications, created on startup
+broadcaster = None
+
+# localized country names by country code, updated from Wikidata
+labels = {}
+if os.path.exists(LABELS_FILE):
+    with open(LABELS_FILE, 'r', encoding="utf-8") as f:
+        labels = json.load(f)
 
 # command /start
 def command_start(update, context):
@@ -52,32 +89,45 @@ def get_name_and_icon(code, icon=None):
         icon = flag(code)
     return name, icon
 
-def format_stats(update, code, data, icon=None, detailed=True):
+# formatted stats texts by place, language and data version
+stats_texts = LRUCache(maxsize=TEXT_CACHE_SIZE)
+
+# identifies the data a text was formatted from, vaccinations are updated separately from the other values
+def get_data_version(data):
+    return (data['updated'], str(data.get('vaccinations')))
+
+def format_stats(code, data, user_lang, icon=None, detailed=True):
+    user_lang = language(user_lang)
+    key = (code, user_lang, icon, detailed, get_data_version(data))
+    text = stats_texts.get(key)
+    if text is not None:
+        return text
     name, icon = get_name_and_icon(code, icon=icon)
     p_dead = data['deaths'] / data['cases']
     if 'active' in data and 'todayCases' in data: # we have detailed data, so use more detailed view
         p_active = data['active'] / data['cases']
         p_recov = data['recovered'] / data['cases']
-        text = resolve('stats_table', lang(update), name, icon, data['cases'],
+        text = resolve('stats_table', user_lang, name, icon, data['cases'],
                 data['active'], p_active, data['recovered'], p_recov, data['deaths'], p_dead,
                 data.get('vaccinations', math.nan),
                 data['todayCases'], data['todayDeaths'])
         if detailed:
-            text += '\n'+resolve('stats_table_more', lang(update), data['casesPerOneMillion'],
+            text += '\n'+resolve('stats_table_more', user_lang, data['casesPerOneMillion'],
                             data['deathsPerOneMillion'], data['testsPerOneMillion'])
     else: # we only have limited data
-        text = resolve('stats_table_simple', lang(update), name, icon, data['cases'], data['deaths'], p_dead)
-    text += '\n'+resolve('stats_updated', lang(update), datetime.utcfromtimestamp(data['updated'] / 1e3))
+        text = resolve('stats_table_simple', user_lang, name, icon, data['cases'], data['deaths'], p_dead)
+    text += '\n'+resolve('stats_updated', user_lang, datetime.utcfromtimestamp(data['updated'] / 1e3))
+    stats_texts.set(key, text)
     return text
 
-def get_stats_keyboard(update, country_code):
+def get_stats_keyboard(country_code, user_lang):
     keyboard = []
     keyboard.append([
-        InlineKeyboardButton(resolve("stats_map", lang(update)), callback_data="map {}".format(country_code))
+        InlineKeyboardButton(resolve("stats_map", user_lang), callback_data="map {}".format(country_code))
     ])
     keyboard.append([
-        InlineKeyboardButton(resolve("stats_graph_cases", lang(update)), callback_data="graph {}".format(country_code)),
-        InlineKeyboardButton(resolve("stats_graph_vacc", lang(update)), callback_data="vacc {}".format(country_code))
+        InlineKeyboardButton(resolve("stats_graph_cases", user_lang), callback_data="graph {}".format(country_code)),
+        InlineKeyboardButton(resolve("stats_graph_vacc", user_lang), callback_data="vacc {}".format(country_code))
     ])
     return InlineKeyboardMarkup(keyboard)
 
@@ -85,12 +135,17 @@ def get_stats_keyboard(update, country_code):
 def get_status_report(country_code=None, lang="en"):
     data = api.cases_world()
     if data:
+        lang = language(lang)
+        # fetch data of home country if set
+        country_data = api.cases_country(country_code) if country_code else None
+        key = ('today', country_code, lang, get_data_version(data), country_data and get_data_version(country_data))
+        text = stats_texts.get(key)
+        if text is not None:
+            return text
         dt = datetime.utcfromtimestamp(data['updated'] / 1e3)
         text = resolve('today', lang,
                 dt, dt, data['cases'], data['deaths'], data['todayCases'], data['todayDeaths'], data['vaccinations'])
-        # fetch data of home country if set
         if country_code:
-            country_data = api.cases_country(country_code)
             text += '\n'+resolve('today_country', lang, flag(country_code),
                             api.countries[country_code]['name'], country_data['cases'], country_data['deaths'],
                             country_data['todayCases'], country_data['todayDeaths'],
@@ -99,6 +154,7 @@ def get_status_report(country_code=None, lang="en"):
         else:
             text += '\n_'+resolve('no_country_set', lang)+'_\n'
         text += '\n'+resolve('today_footer', lang)
+        stats_texts.set(key, text)
     else:
         text = resolve('no_data',lang)
     return text
@@ -142,13 +198,6 @@ def get_list_keyboard(update, current_index, limit, last=False):
     ])
     return InlineKeyboardMarkup(keyboard)
 
-SORT_ORDERS = [
-    'cases', 'deaths',
-    'casesPerOneMillion', 'deathsPerOneMillion',
-    'todayCases', 'todayDeaths',
-    'vaccinations',
-]
-
 def get_list_order_keyboard(update, current_index, limit, last=False):
     keyboard = []
     l = None
@@ -168,38 +217,59 @@ def get_list_order_keyboard(update, current_index, limit, last=False):
 # command /world
 @handler_decorator
 def command_world(update, context):
+    user_lang = lang(update)
     data = api.cases_world()
     if data:
-        text = format_stats(update, WORLD_IDENT, data)
-        update.message.reply_markdown(text, reply_markup=get_stats_keyboard(update, WORLD_IDENT))
+        text = format_stats(WORLD_IDENT, data, user_lang)
+        update.message.reply_markdown(text, reply_markup=get_stats_keyboard(WORLD_IDENT, user_lang))
     else:
-        update.message.reply_text(resolve('no_data', lang(update)))
+        update.message.reply_text(resolve('no_data', user_lang))
 
 # command /[country]
 @handler_decorator
 def command_country(update, context, country_code):
+    user_lang = lang(update)
     data = api.cases_country(country_code)
     if data:
-        text = format_stats(update, country_code, data)
-        update.message.reply_markdown(text, reply_markup=get_stats_keyboard(update, country_code))
+        text = format_stats(country_code, data, user_lang)
+        update.message.reply_markdown(text, reply_markup=get_stats_keyboard(country_code, user_lang))
     else:
-        update.message.reply_text(resolve('no_data', lang(update)))
+        update.message.reply_text(resolve('no_data', user_lang))
 
 def command_us_state(update, context, state):
+    user_lang = lang(update)
     data = api.cases_us_state(state)
     if data:
-        text = format_stats(update, state.title(), data, icon='\uD83C\uDDFA\uD83C\uDDF8')
+        text = format_stats(state.title(), data, user_lang, icon='\uD83C\uDDFA\uD83C\uDDF8')
         update.message.reply_markdown(text)
     else:
-        update.message.reply_text(resolve('no_data', lang(update)))
+        update.message.reply_text(resolve('no_data', user_lang))
 
 def command_de_state(update, context, state):
+    user_lang = lang(update)
     data = api.cases_de_state(state)
     if data:
-        text = format_stats(update, state.title(), data, icon='\uD83C\uDDE9\uD83C\uDDEA')
+        text = format_stats(state.title(), data, user_lang, icon='\uD83C\uDDE9\uD83C\uDDEA')
         update.message.reply_markdown(text)
     else:
-        update.message.reply_text(resolve('no_data', lang(update)))
+        update.message.reply_text(resolve('no_data', user_lang))
+
+# returns the lower-case command of a message or None if it is addressed to another bot
+def get_command(message):
+    command = message.text[1:message.entities[0].length].lower()
+    command, _, username = command.partition('@')
+    if username and username != message.bot.username.lower():
+        return None
+    return command
+
+class CountryCommandFilter(MessageFilter):
+    """Matches all country commands, looked up in the command map of the api."""
+    def filter(self, message):
+        return get_command(message) in api.command_map
+
+# command /[country], routed by a single handler, so that the country list can change at runtime
+def handle_country_command(update, context):
+    command_country(update, context, api.command_map[get_command(update.message)])
 
 ### Country list ###
 
@@ -219,10 +289,7 @@ def command_list(update, context):
     # by default, return 8 items. min 2 and max 20.
     limit = int(context.args[1]) if len(context.args) > 1 else 8
     limit = min(max(2, limit), 20)
-    if order in ["vaccinations"]:
-        case_list = api.vaccinations_country_list(sort_by=order)[:limit]
-    else:
-        case_list = api.cases_country_list(sort_by=order)[:limit]
+    case_list = api.country_ranking(order)[:limit]
     if len(case_list) > 0:
         text = resolve('list_header', lang(update), resolve("sort_order_"+order, lang(update)))
         for item in case_list:
@@ -235,10 +302,7 @@ def callback_list_pages(update, context):
     query = update.callback_query
     order = context.chat_data.get('order', SORT_ORDERS[0]) # for backward comp
     page, limit = int(context.match.group(1)), int(context.match.group(2))
-    if order in ["vaccinations"]:
-        case_list = api.vaccinations_country_list(sort_by=order)
-    else:
-        case_list = api.cases_country_list(sort_by=order)
+    case_list = api.country_ranking(order)
     if page >= 0:
         case_list = case_list[page*limit:(page+1)*limit]
     else:
@@ -273,10 +337,7 @@ def callback_list_order(update, context):
     # save the selected order
     context.chat_data['order'] = order
     limit = int(context.match.group(2))
-    if order in ["vaccinations"]:
-        case_list = api.vaccinations_country_list(sort_by=order)[:limit]
-    else:
-        case_list = api.cases_country_list(sort_by=order)[:limit]
+    case_list = api.country_ranking(order)[:limit]
     query.answer()
     if len(case_list) > 0:
         text = resolve('list_header', lang(update), resolve("sort_order_"+order, lang(update)))
@@ -288,6 +349,33 @@ def callback_list_order(update, context):
         query.edit_message_text(resolve('no_data', lang(update)),
                                 reply_markup=get_list_keyboard(update, 0, limit, len(case_list) < limit))
 
+### Photos ###
+
+# Sends a photo through send(photo), which returns the sent message. Once a photo has been uploaded,
+# Telegram's file_id of it is stored and reused until the version of the photo changes.
+def send_photo_cached(context, send, kind, code, version, render):
+    file_ids = context.bot_data.setdefault('file_ids', {})
+    cached = file_ids.get((kind, code))
+    if cached and cached[0] == version:
+        try:
+            return send(cached[1])
+        except BadRequest as ex:
+            # only an invalid or expired file id is worth an upload, other errors are raised
+            if "file" not in ex.message.lower():
+                raise
+            logger.warning("Failed to resend {} {} by file id: {}".format(kind, code, ex.message))
+            file_ids.pop((kind, code), None)
+    message = send(render())
+    if message and message.photo:
+        file_ids[(kind, code)] = (version, message.photo[-1].file_id)
+    return message
+
+def get_map(code):
+    if code == WORLD_IDENT:
+        return wikidata.cases_world_map()
+    else:
+        return wikidata.cases_country_map(code)
+
 ### Map ###
 
 # command: /map
@@ -295,86 +383,84 @@ def callback_list_order(update, context):
 def command_map(update, context):
     code = None
     if len(context.args) > 0:
-        resolved = resolve_query_string(context.args[0])
+        resolved = resolve_query_string(context.args[0], fuzzy=True)
         if resolved:
             code = resolved
-            photo = wikidata.cases_country_map(code)
         elif WORLD_IDENT in context.args[0]:
             code = WORLD_IDENT
-            photo = wikidata.cases_world_map()
         else:
             update.message.reply_text(resolve('unknown_place', lang(update)))
             return
     else:
-        if 'country' in context.chat_data:
-            code = context.chat_data['country']
-            photo = wikidata.cases_country_map(code)
-        else:
-            code = WORLD_IDENT
-            photo = wikidata.cases_world_map()
+        code = context.chat_data.get('country', WORLD_IDENT)
+    photo = get_map(code)
     if photo:
         caption = resolve("map_caption", lang(update), *get_name_and_icon(code))
-        update.message.reply_photo(photo=photo, caption=caption, parse_mode=ParseMode.MARKDOWN)
+        send = lambda photo: update.message.reply_photo(photo=photo, caption=caption, parse_mode=ParseMode.MARKDOWN)
+        send_photo_cached(context, send, "map", code, photo, lambda: photo)
     else:
         update.message.reply_text(resolve('unknown_place', lang(update)))
 
 @handler_decorator
 def callback_map(update, context):
     code = context.match.group(1)
-    if code == WORLD_IDENT:
-        photo = wikidata.cases_world_map()
-    else:
-        photo = wikidata.cases_country_map(code)
+    photo = get_map(code)
     if photo:
         caption = resolve("map_caption", lang(update), *get_name_and_icon(code))
         update.callback_query.answer()
-        context.bot.send_photo(
+        send = lambda photo: context.bot.send_photo(
             chat_id=update.callback_query.message.chat_id,
             photo=photo, caption=caption,
             parse_mode=ParseMode.MARKDOWN,
         )
+        send_photo_cached(context, send, "map", code, photo, lambda: photo)
     else:
         update.callback_query.answer()
         context.bot.send_message(chat_id=update.callback_query.message.chat_id, text=resolve('no_data', lang(update)))
 
 ### Graphs ###
 
+# returns False if the chart could not be rendered because the renderer is overloaded or failed
+def send_chart(context, send, kind, code, data):
+    activity.record_chart(code)
+    render = lambda: io.BytesIO(render_chart(kind, data, service=renderer))
+    try:
+        send_photo_cached(context, send, kind, code, data_version(data), render)
+        return True
+    except RenderError as ex:
+        logger.warning("Failed to render {} chart of {}: {!r}".format(kind, code, ex))
+        return False
+
 # command: /graph
 @handler_decorator
 def command_graph(update, context):
     if len(context.args) > 0:
-        resolved = resolve_query_string(context.args[0])
+        resolved = resolve_query_string(context.args[0], fuzzy=True)
         if resolved:
-            data = api.timeseries(resolved)
+            code = resolved
         elif WORLD_IDENT in context.args[0]:
-            data = api.timeseries()
+            code = WORLD_IDENT
         else:
             update.message.reply_text(resolve('unknown_place', lang(update)))
             return
     else:
-        if 'country' in context.chat_data:
-            country_code = context.chat_data['country']
-            data = api.timeseries(country_code)
-        else:
-            data = api.timeseries()
+        code = context.chat_data.get('country', WORLD_IDENT)
+    data = api.timeseries(None if code == WORLD_IDENT else code)
     if data:
-        buffer = plot_timeseries(data)
-        update.message.reply_photo(photo=buffer)
-        buffer.close()
+        if not send_chart(context, lambda photo: update.message.reply_photo(photo=photo), "cases", code, data):
+            update.message.reply_text(resolve('busy', lang(update)))
     else:
         update.message.reply_text(resolve('no_data', lang(update)))
 
 @handler_decorator
 def callback_graph(update, context):
-    country_code = context.match.group(1)
-    if country_code == WORLD_IDENT:
-        country_code = None
-    data = api.timeseries(country_code)
+    code = context.match.group(1)
+    data = api.timeseries(None if code == WORLD_IDENT else code)
     if data:
-        buffer = plot_timeseries(data)
         update.callback_query.answer()
-        context.bot.send_photo(chat_id=update.callback_query.message.chat_id, photo=buffer)
-        buffer.close()
+        chat_id = update.callback_query.message.chat_id
+        if not send_chart(context, lambda photo: context.bot.send_photo(chat_id=chat_id, photo=photo), "cases", code, data):
+            context.bot.send_message(chat_id=chat_id, text=resolve('busy', lang(update)))
     else:
         update.callback_query.answer()
         context.bot.send_message(chat_id=update.callback_query.message.chat_id, text=resolve('no_data', lang(update)))
@@ -385,45 +471,64 @@ def callback_graph(update, context):
 @handler_decorator
 def command_vacc(update, context):
     if len(context.args) > 0:
-        resolved = resolve_query_string(context.args[0])
+        resolved = resolve_query_string(context.args[0], fuzzy=True)
         if resolved:
-            data = api.vaccinations_series(resolved)
+            code = resolved
         elif WORLD_IDENT in context.args[0]:
-            data = api.vaccinations_series()
+            code = WORLD_IDENT
         else:
             update.message.reply_text(resolve('unknown_place', lang(update)))
             return
     else:
-        if 'country' in context.chat_data:
-            country_code = context.chat_data['country']
-            data = api.vaccinations_series(country_code)
-        else:
-            data = api.vaccinations_series()
+        code = context.chat_data.get('country', WORLD_IDENT)
+    data = api.vaccinations_series(None if code == WORLD_IDENT else code)
     if data:
-        buffer = plot_vaccinations_series(data)
-        update.message.reply_photo(photo=buffer)
-        buffer.close()
+        if not send_chart(context, lambda photo: update.message.reply_photo(photo=photo), "vacc", code, data):
+            update.message.reply_text(resolve('busy', lang(update)))
     else:
         update.message.reply_text(resolve('no_data', lang(update)))
 
 @handler_decorator
 def callback_vacc(update, context):
-    country_code = context.match.group(1)
-    if country_code == WORLD_IDENT:
-        country_code = None
-    data = api.vaccinations_series(country_code)
+    code = context.match.group(1)
+    data = api.vaccinations_series(None if code == WORLD_IDENT else code)
     if data:
-        buffer = plot_vaccinations_series(data)
         update.callback_query.answer()
-        context.bot.send_photo(chat_id=update.callback_query.message.chat_id, photo=buffer)
-        buffer.close()
+        chat_id = update.callback_query.message.chat_id
+        if not send_chart(context, lambda photo: context.bot.send_photo(chat_id=chat_id, photo=photo), "vacc", code, data):
+            context.bot.send_message(chat_id=chat_id, text=resolve('busy', lang(update)))
     else:
         update.callback_query.answer()
         context.bot.send_message(chat_id=update.callback_query.message.chat_id, text=resolve('no_data', lang(update)))
 
 ### Free text & inline ###
 
-def resolve_query_string(query_string):
+# checks if two tuples contain the same objects, the cached objects are kept so that their ids are not reused
+def same_objects(a, b):
+    return a is not None and len(a) == len(b) and all(x is y for x, y in zip(a, b))
+
+_name_resolver = (None, None)
+
+# returns the resolver of all country names and localized names, rebuilt whenever the names change
+def get_name_resolver():
+    global _name_resolver
+    key = (api.name_map, labels)
+    if not same_objects(_name_resolver[0], key):
+        names = dict(api.name_map)
+        label_codes = {}
+        for code, country_labels in labels.items():
+            if code in api.countries:
+                for label in country_labels:
+                    label_codes.setdefault(normalize(label), set()).add(code)
+        for label, codes in label_codes.items():
+            # labels shared by several countries are left out, as they would resolve to an arbitrary one
+            if len(codes) == 1:
+                names.setdefault(label, codes.pop())
+        _name_resolver = (key, NameResolver(names))
+    return _name_resolver[1]
+
+# resolves a country code from a code, (localized) name or flag, with fuzzy also tolerating typos
+def resolve_query_string(query_string, fuzzy=False):
     query_string = query_string.lower()
     if query_string in api.name_map:
         return api.name_map[query_string]
@@ -431,7 +536,8 @@ def resolve_query_string(query_string):
         code = code_from_flag(query_string).lower()
         if code in api.name_map:
             return api.name_map[code]
-    return None
+        return None
+    return get_name_resolver().resolve(query_string, fuzzy=fuzzy)
 
 # free text input
 @handler_decorator
@@ -447,7 +553,23 @@ def handle_text(update, context):
     elif query_string.title() in api.de_states:
         command_de_state(update, context, query_string)
     else:
-        update.message.reply_text(resolve('unknown_place', lang(update)))
+        # only try to correct typos if no other place matches exactly
+        resolved = resolve_query_string(query_string, fuzzy=True)
+        if resolved:
+            command_country(update, context, resolved)
+        else:
+            update.message.reply_text(resolve('unknown_place', lang(update)))
+
+_search_indexes = (None, [])
+
+# returns the prefix indexes of all place names, rebuilt whenever the names in the api change
+def get_search_indexes():
+    global _search_indexes
+    sources = [("country", api.name_map), ("us_state", api.us_states), ("de_state", api.de_states)]
+    key = tuple(names for _, names in sources)
+    if not same_objects(_search_indexes[0], key):
+        _search_indexes = (key, [(kind, PrefixIndex(names)) for kind, names in sources])
+    return _search_indexes[1]
 
 # inline queries
 def handle_inlinequery(update, context):
@@ -459,40 +581,31 @@ def handle_inlinequery(update, context):
     # a special case matching 'world'
     if WORLD_IDENT.startswith(query_string):
         results.append((WORLD_IDENT, WORLD_IDENT))
-    for name in api.name_map.keys():
-        if name.startswith(query_string):
-            results.append((name, "country"))
-        # limit to the first threee results
-        if len(results) >= 3:
-            break
-    if len(results) < 3:
-        for state in api.us_states:
-            if state.lower().startswith(query_string):
-                results.append((state.lower(), "us_state"))
-            if len(results) >= 3:
-                break
-    if len(results) < 3:
-        for state in api.de_states:
-            if state.lower().startswith(query_string):
-                results.append((state.lower(), "de_state"))
-            if len(results) >= 3:
-                break
+    # limit to the first three results, preferring countries over states
+    for kind, index in get_search_indexes():
+        results += [(name, kind) for name in index.search(query_string, limit=3 - len(results))]
+    # fall back to localized names and names with typos
+    if not results:
+        code = resolve_query_string(query_string, fuzzy=True)
+        if code:
+            results.append((api.countries[code]['name'].lower(), "country"))
+    user_lang = lang(update)
     query_results = []
     for i,(s, t) in enumerate(results):
         if t == WORLD_IDENT:
             data = api.cases_world()
-            text = format_stats(update, WORLD_IDENT, data, detailed=True)
+            text = format_stats(WORLD_IDENT, data, user_lang, detailed=True)
         elif t == "us_state":
             data = api.cases_us_state(s)
-            text = format_stats(update, s.title(), data, icon='\uD83C\uDDFA\uD83C\uDDF8')
+            text = format_stats(s.title(), data, user_lang, icon='\uD83C\uDDFA\uD83C\uDDF8')
         elif t == "de_state":
             data = api.cases_de_state(s)
-            text = format_stats(update, s.title(), data, icon='\uD83C\uDDE9\uD83C\uDDEA')
+            text = format_stats(s.title(), data, user_lang, icon='\uD83C\uDDE9\uD83C\uDDEA')
         else:
             country_code = api.name_map[s]
             data = api.cases_country(country_code)
-            text = format_stats(update, country_code, data, detailed=True)
-        text+='\n'+resolve('more', lang(update))
+            text = format_stats(country_code, data, user_lang, detailed=True)
+        text+='\n'+resolve('more', user_lang)
         result_content = InputTextMessageContent(text, parse_mode=ParseMode.MARKDOWN)
         query_results.append(
             InlineQueryResultArticle(id=i, title=s, input_message_content=result_content)
@@ -508,9 +621,8 @@ def handle_setcountry_start(update, context):
     return 1
 
 def handle_setcountry_input(update, context):
-    query_string = update.message.text.lower()
-    if query_string in api.name_map:
-        code = api.name_map[query_string]
+    code = resolve_query_string(update.message.text, fuzzy=True)
+    if code:
         context.chat_data['country'] = code
         update.message.reply_markdown(
                 resolve('setcountry_success', lang(update), api.countries[code]['name']))
@@ -530,6 +642,8 @@ def command_subscribe(update, context):
         context.bot_data['subscribers'] = [update.message.chat.id]
     elif not update.message.chat.id in context.bot_data['subscribers']:
         context.bot_data['subscribers'].append(update.message.chat.id)
+    # daily notifications are sent in the language of the subscribing user
+    context.chat_data['lang'] = lang(update)
     update.message.reply_markdown(resolve('subscribe', lang(update)))
 
 @handler_decorator
@@ -541,23 +655,87 @@ def command_unsubscribe(update, context):
 
 # runs the status notification job once per day
 def run_notify(context):
-    if not 'subscribers' in context.bot_data:
+    # a broadcast id is only given when resuming an interrupted broadcast
+    broadcast_id = context.job.context or "daily-{}".format(datetime.utcnow().strftime("%Y-%m-%d"))
+    context.dispatcher.run_async(notify_subscribers, context.dispatcher, broadcast_id)
+
+def notify_subscribers(dispatcher, broadcast_id):
+    if not 'subscribers' in dispatcher.bot_data:
         logger.warn("No subscribers list specified.")
         return
-    count = 0
-    for chat_id in context.bot_data['subscribers']:
+    subscribers = dispatcher.bot_data['subscribers']
+    # render each distinct report only once per home country and language
+    reports = {}
+    messages = []
+    for chat_id in list(subscribers):
+        chat_data = dispatcher.chat_data[chat_id]
+        key = (chat_data.get('country', None), language(chat_data.get('lang', None)))
+        if key not in reports:
+            reports[key] = get_status_report(country_code=key[0], lang=key[1])
+        messages.append((chat_id, reports[key]))
+    # chats that blocked or kicked the bot, collected from the sending threads
+    forbidden = []
+    count = broadcaster.send(broadcast_id, messages, on_forbidden=forbidden.append)
+    logger.info("Successfully sent daily notification to {} users ({} distinct reports).".format(count, len(reports)))
+    # remove users from subscribers if they blocked or kicked the bot
+    for chat_id in forbidden:
+        if chat_id in subscribers:
+            subscribers.remove(chat_id)
+    if broadcast_id in broadcaster.unfinished():
+        dispatcher.job_queue.run_once(run_notify, BROADCAST_RETRY_DELAY, context=broadcast_id)
+
+# renders the charts of the world and the configured or most requested countries into the chart cache
+def prerender_charts(config, chart_requests):
+    if 'prerender_countries' in config:
+        codes = [api.name_map[c.lower()] for c in config['prerender_countries'] if c.lower() in api.name_map]
+    else:
+        count = config.get('prerender_count', PRERENDER_COUNT)
+        codes = [code for code, _ in chart_requests.most_common() if code != WORLD_IDENT][:count]
+    for code in [WORLD_IDENT] + codes:
+        country_code = None if code == WORLD_IDENT else code
         try:
-            country_code = context.dispatcher.chat_data[chat_id].get('country', None)
-            text = get_status_report(country_code=country_code) # TODO always English
-            context.bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.MARKDOWN)
-            count+=1
-            sleep(0.05) # try to avoid flood limits
-        except Exception as ex:
-            # remove user from subscribers if he blocked or kicked the bot
-            if isinstance(ex, TelegramError) and ex.message.startswith("Forbidden: "):
-                context.bot_data['subscribers'].remove(chat_id)
-            logger.error("Failed to send daily notification to {}".format(chat_id), exc_info=True)
-    logger.info("Successfully sent daily notification to {} users.".format(count))
+            for kind, data in [("cases", api.timeseries(country_code)), ("vacc", api.vaccinations_series(country_code))]:
+                if data:
+                    render_chart(kind, data, service=renderer)
+        except RenderError:
+            logger.warning("Stopped pre-rendering charts as the renderer is busy.", exc_info=True)
+            return
+    logger.info("Pre-rendered charts for {} places.".format(len(codes) + 1))
+
+# aggregates the buffered user activity and writes all changed data to the database
+def run_flush(context):
+    activity.flush(context.dispatcher)
+    context.dispatcher.persistence.flush()
+
+# keeps all data served by the api warm
+def run_refresh(context):
+    config = context.job.context
+    interval = config.get('refresh_interval', REFRESH_INTERVAL)
+    # keep fetched data at least until the next refresh is due
+    if api.refresh(ttl=2*interval):
+        logger.info("Refreshed data.")
+        context.dispatcher.run_async(prerender_charts, config, activity.chart_requests())
+    else:
+        last = datetime.utcfromtimestamp(api.last_refreshed) if api.last_refreshed else None
+        logger.warning("Failed to refresh data, last successful refresh at {}.".format(last))
+
+# updates the localized country names once per day
+def run_update_labels(context):
+    global labels
+    new_labels = wikidata.country_labels()
+    if new_labels:
+        with open(LABELS_FILE + ".tmp", 'w', encoding="utf-8") as f:
+            json.dump(new_labels, f)
+        os.replace(LABELS_FILE + ".tmp", LABELS_FILE)
+        labels = new_labels
+    else:
+        logger.warning("Failed to update country labels.")
+
+# resolves the maps of all countries that are missing or outdated
+def run_update_maps(context):
+    country_codes = wikidata.outdated_maps(api.countries)
+    if country_codes and not wikidata.update_maps(country_codes):
+        logger.warning("Failed to update maps of {} countries.".format(len(country_codes)))
 
 def error(update, context):
     try:
@@ -566,7 +744,10 @@ def error(update, context):
         logger.warning('Update {} caused error "{}"'.format(update, context.error))
 
 def main(config):
-    persistence = PicklePersistence("database.pkl")
+    global renderer, api
+    renderer = RenderService(workers=config.get('render_workers', RENDER_WORKERS))
+    api = CovidApi(history=HistoryStore(HISTORY_DIR), metadata_file=METADATA_FILE)
+    persistence = SqlitePersistence(DATABASE_FILE, migrate_from=LEGACY_DATABASE_FILE)
     updater = Updater(config['token'], persistence=persistence, use_context=True)
     # add commands
     dp = updater.dispatcher
@@ -587,14 +768,8 @@ def main(config):
     dp.add_handler(CallbackQueryHandler(callback_list_pages, pattern=r"list (-?\d+) (\d+)"))
     dp.add_handler(CallbackQueryHandler(callback_list_order_menu, pattern=r"list_order_menu (\d+) \(([\d\s]+)\)"))
     dp.add_handler(CallbackQueryHandler(callback_list_order, pattern=r"list_order (\w+) (\d+)"))
-    # for every country, add a command for the iso2 and iso3 codes and the name
-    for iso, country in api.countries.items():
-        callback = lambda update, context, code=iso: command_country(update, context, code)
-        dp.add_handler(CommandHandler(iso, callback))
-        if country['iso3']:
-            dp.add_handler(CommandHandler(country['iso3'], callback))
-        name_normal = re.sub(r"[^a-z]", "_", country['name'].lower())
-        dp.add_handler(CommandHandler(name_normal, callback))
+    # for every country, handle commands for the iso2 and iso3 codes and the name
+    dp.add_handler(MessageHandler(Filters.command & CountryCommandFilter(), handle_country_command))
     # set country (this has to be added before the free text handler)
     dp.add_handler(ConversationHandler(
         entry_points=[CommandHandler("setcountry", handle_setcountry_start)],
@@ -609,8 +784,21 @@ def main(config):
     dp.add_handler(CommandHandler("unsubscribe", command_unsubscribe))
     # subscription job
     job_queue = updater.job_queue
+    global broadcaster
+    broadcaster = Broadcaster(updater.bot, DATABASE_FILE)
     if 'notify_time' in config:
         job_queue.run_daily(run_notify, datetime.strptime(config['notify_time'], '%H:%M').time())
+    # resume broadcasts interrupted by a restart
+    for broadcast_id in broadcaster.unfinished():
+        job_queue.run_once(run_notify, 0, context=broadcast_id)
+    activity.connect(DATABASE_FILE)
+    # chart requests were counted in the persisted bot data before
+    dp.bot_data.pop('chart_requests', None)
+    job_queue.run_repeating(run_flush, FLUSH_INTERVAL)
+    # background data refresh job
+    job_queue.run_repeating(run_refresh, config.get('refresh_interval', REFRESH_INTERVAL), first=0, context=config)
+    job_queue.run_repeating(run_update_labels, 24*60*60, first=0)
+    job_queue.run_repeating(run_update_maps, 60*60, first=0)
     # free text input
     dp.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_text))
     dp.add_handler(InlineQueryHandler(handle_inlinequery))
@@ -618,6 +806,10 @@ def main(config):
     # start the bot
     updater.start_polling()
     updater.idle()
+    # the signal handler only flushes the persistence, so write the activity buffered since the last flush
+    activity.flush(dp)
+    persistence.flush()
+    renderer.shutdown()
 
 if __name__ == "__main__":
     with open(CONFIG_FILE, 'r') as f:
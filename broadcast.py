@@ -0,0 +1,142 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import monotonic, sleep
+import logging
+import sqlite3
+
+from telegram import ParseMode
+from telegram.error import RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """A thread-safe token bucket allowing `rate` acquisitions per second with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._time = monotonic()
+        self._paused_until = 0
+        self._lock = Lock()
+
+    def pause(self, seconds):
+        """Lets no acquisition succeed for the given time, after which the bucket starts refilling from empty."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, monotonic() + seconds)
+            self._time = self._paused_until
+            self._tokens = 0
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._time) * self.rate)
+                    self._time = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            sleep(wait)
+
+
+class Broadcaster:
+    """Sends messages to many chats concurrently within Telegram's rate limits.
+
+    Chats that were sent a message are recorded per broadcast in a SQLite database, so an interrupted
+    broadcast can be resumed by sending it again under the same id.
+    """
+
+    # Telegram allows about 30 messages per second overall and one message per second per chat
+    RATE = 25
+    CHAT_INTERVAL = 1
+    MAX_RETRIES = 3
+
+    def __init__(self, bot, filename, workers=8):
+        self.bot = bot
+        self.workers = workers
+        self._bucket = TokenBucket(self.RATE)
+        self._last_sent = {}
+        self._lock = Lock()
+        self._connection = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS broadcasts (id TEXT PRIMARY KEY, finished INTEGER);
+            CREATE TABLE IF NOT EXISTS broadcast_progress (id TEXT, chat_id INTEGER, PRIMARY KEY (id, chat_id));
+        """)
+
+    def unfinished(self):
+        """Returns the ids of all broadcasts that were started but not finished."""
+        return [row[0] for row in self._connection.execute("SELECT id FROM broadcasts WHERE finished = 0")]
+
+    def _wait_for_chat(self, chat_id):
+        with self._lock:
+            wait = self._last_sent.get(chat_id, 0) + self.CHAT_INTERVAL - monotonic()
+            self._last_sent[chat_id] = monotonic() + max(wait, 0)
+        if wait > 0:
+            sleep(wait)
+
+    # returns True if the message was sent, False if it failed and None if the flood limit was hit on every try
+    def _send(self, broadcast_id, chat_id, text, on_forbidden):
+        for _ in range(self.MAX_RETRIES):
+            self._wait_for_chat(chat_id)
+            self._bucket.acquire()
+            try:
+                self.bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.MARKDOWN)
+            except RetryAfter as ex:
+                logger.info("Flood limit hit, retrying in {} seconds.".format(ex.retry_after))
+                # the limit applies to the bot, so all workers wait
+                self._bucket.pause(ex.retry_after)
+            except Exception as ex:
+                # the user blocked or kicked the bot
+                if isinstance(ex, TelegramError) and ex.message.startswith("Forbidden: ") and on_forbidden:
+                    on_forbidden(chat_id)
+                logger.error("Failed to send broadcast {} to {}".format(broadcast_id, chat_id), exc_info=True)
+                return False
+            else:
+                self._record_progress(broadcast_id, chat_id)
+                return True
+        return None
+
+    def _record_progress(self, broadcast_id, chat_id):
+        try:
+            with self._lock, self._connection:
+                self._connection.execute("INSERT OR IGNORE INTO broadcast_progress VALUES (?, ?)", (broadcast_id, chat_id))
+        except sqlite3.Error:
+            # the message was sent anyway, but would be sent again if the broadcast is resumed
+            logger.warning("Failed to record broadcast {} to {}".format(broadcast_id, chat_id), exc_info=True)
+
+    def send(self, broadcast_id, messages, on_forbidden=None):
+        """Sends all (chat_id, text) messages that were not yet sent in the broadcast with the given id.
+
+        `on_forbidden(chat_id)` is called for chats that blocked the bot. Returns the number of messages sent.
+        If messages could not be sent because of the flood limit, the broadcast is left unfinished, so
+        sending it again later retries these chats.
+        """
+        row = self._connection.execute("SELECT finished FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+        if row and row[0]:
+            logger.warning("Broadcast {} was already sent.".format(broadcast_id))
+            return 0
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR IGNORE INTO broadcasts VALUES (?, 0)", (broadcast_id,))
+        sent = set(row[0] for row in self._connection.execute(
+            "SELECT chat_id FROM broadcast_progress WHERE id = ?", (broadcast_id,)))
+        pending = [(chat_id, text) for chat_id, text in messages if chat_id not in sent]
+        if sent:
+            logger.info("Resuming broadcast {}, {} chats already done.".format(broadcast_id, len(sent)))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(lambda m: self._send(broadcast_id, m[0], m[1], on_forbidden), pending))
+        self._last_sent.clear()
+        limited = [chat_id for (chat_id, _), result in zip(pending, results) if result is None]
+        if limited:
+            logger.warning("Broadcast {} left unfinished, {} chats were not sent to because of the flood limit: {}".format(
+                broadcast_id, len(limited), limited))
+            return results.count(True)
+        # the progress of a finished broadcast is not needed anymore
+        with self._lock, self._connection:
+            self._connection.execute("UPDATE broadcasts SET finished = 1 WHERE id = ?", (broadcast_id,))
+            self._connection.execute("DELETE FROM broadcast_progress WHERE id = ?", (broadcast_id,))
+        return results.count(True)
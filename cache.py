@@ -0,0 +1,99 @@
+from collections import OrderedDict
+from threading import RLock
+from time import monotonic
+
+
+class LRUCache:
+    """A thread-safe, size-bounded cache evicting the least recently used entries first.
+
+    By default, every entry has a size of 1, so `maxsize` is the maximum number of entries.
+    Pass `getsizeof` to bound the cache by a different measure (e.g. number of bytes).
+    """
+
+    def __init__(self, maxsize=1024, getsizeof=None):
+        self.maxsize = maxsize
+        self.getsizeof = getsizeof or (lambda value: 1)
+        self.hits = 0
+        self.misses = 0
+        self.currsize = 0
+        self._data = OrderedDict()
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def get(self, key, default=None, count=True):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                if count:
+                    self.hits += 1
+                return self._data[key][0]
+            if count:
+                self.misses += 1
+            return default
+
+    def set(self, key, value):
+        size = self.getsizeof(value)
+        if size > self.maxsize:
+            return
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (value, size)
+            self.currsize += size
+            while self.currsize > self.maxsize:
+                self._remove(next(iter(self._data)))
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                value = self._data[key][0]
+                self._remove(key)
+                return value
+            return default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.currsize = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": self.currsize, "maxsize": self.maxsize}
+
+    def _remove(self, key):
+        if key in self._data:
+            _, size = self._data.pop(key)
+            self.currsize -= size
+
+
+class TTLCache(LRUCache):
+    """An LRU cache whose entries expire after a time-to-live given in seconds.
+
+    The time-to-live can be set per entry, otherwise `ttl` is used.
+    """
+
+    def __init__(self, maxsize=1024, ttl=600, getsizeof=None, timer=monotonic):
+        # entries are stored together with their expiry time
+        super().__init__(maxsize, getsizeof=(lambda entry: getsizeof(entry[0])) if getsizeof else None)
+        self.ttl = ttl
+        self.timer = timer
+
+    def get(self, key, default=None, count=True):
+        with self._lock:
+            entry = super().get(key, count=False)
+            if entry is not None and entry[1] > self.timer():
+                if count:
+                    self.hits += 1
+                return entry[0]
+            if entry is not None:
+                self._remove(key)
+            if count:
+                self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        super().set(key, (value, self.timer() + ttl))
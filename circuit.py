@@ -0,0 +1,68 @@
+from threading import Lock
+from time import monotonic
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Stops calling a failing upstream for a while instead of letting every request wait for it.
+
+    After `failure_threshold` consecutive failures, the circuit opens and all calls fail immediately with
+    CircuitOpenError. After `reset_timeout` seconds, a single trial call is let through, which closes the
+    circuit again if it succeeds.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=60):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def _allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if not self._trial and monotonic() - self.opened_at >= self.reset_timeout:
+                self._trial = True
+                return True
+            return False
+
+    def record(self, success):
+        """Records the outcome of a call made without call(), e.g. one that must never be skipped."""
+        with self._lock:
+            self._trial = False
+            if success:
+                if self.opened_at is not None:
+                    logger.info("Circuit {} closed.".format(self.name))
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.opened_at is not None or self.failures >= self.failure_threshold:
+                    if self.opened_at is None:
+                        logger.warning("Circuit {} opened after {} failures.".format(self.name, self.failures))
+                    self.opened_at = monotonic()
+
+    def call(self, func, *args, **kwargs):
+        """Calls func, counting any exception it raises as a failure of the upstream."""
+        if not self._allow():
+            raise CircuitOpenError(self.name)
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.record(False)
+            raise
+        self.record(True)
+        return result
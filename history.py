@@ -0,0 +1,118 @@
+from os.path import exists, join
+import json
+import logging
+import os
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryStore:
+    """A local store of the cumulative case and death counts of all countries.
+
+    The series are stored column-wise as one .npy file per metric of shape (days, countries)
+    in the directory `path` and are memory-mapped when loaded.
+    """
+
+    METRICS = ["cases", "deaths"]
+
+    def __init__(self, path):
+        self.path = path
+        # dates, column index by ISO2 code and one array per metric, replaced at once on update
+        self._data = (np.array([], dtype="datetime64[D]"), {}, {})
+        self._load()
+
+    def __contains__(self, code):
+        return code in self._data[1]
+
+    def __len__(self):
+        return len(self._data[0])
+
+    @property
+    def last_date(self):
+        dates = self._data[0]
+        return dates[-1] if len(dates) > 0 else None
+
+    def _file(self, name):
+        return join(self.path, name)
+
+    def _load(self):
+        if not exists(self._file("codes.json")):
+            return
+        try:
+            with open(self._file("codes.json"), "r") as f:
+                codes = json.load(f)
+            dates = np.load(self._file("dates.npy"))
+            metrics = {metric: np.load(self._file(metric + ".npy"), mmap_mode="r") for metric in self.METRICS}
+        except (OSError, ValueError):
+            logger.warning("Failed to load the history store, it is rebuilt.", exc_info=True)
+            return
+        # files of different updates are left if a save was interrupted
+        if any(values.shape != (len(dates), len(codes)) for values in metrics.values()):
+            logger.warning("Discarding the history store, as its files do not match.")
+            return
+        self._data = (dates, {code: i for i, code in enumerate(codes)}, metrics)
+
+    def _save(self, dates, codes, metrics):
+        os.makedirs(self.path, exist_ok=True)
+        # write to temporary files first, so that a crash never leaves a partially written file,
+        # files from different updates are detected and discarded by _load()
+        files = {"dates.npy": dates, **{metric + ".npy": values for metric, values in metrics.items()}}
+        for name, array in files.items():
+            with open(self._file(name + ".tmp"), "wb") as f:
+                np.save(f, array)
+        with open(self._file("codes.json.tmp"), "w") as f:
+            json.dump(codes, f)
+        for name in list(files) + ["codes.json"]:
+            os.replace(self._file(name + ".tmp"), self._file(name))
+
+    def update(self, dates, series):
+        """Merges new data into the store.
+
+        `dates` is a sorted datetime64[D] array and `series` maps ISO2 codes to dicts with one array
+        of cumulative values per metric. Values of already stored dates are overwritten.
+        Returns False if the data was already stored, in which case nothing is written.
+        """
+        old_dates, old_index, old_metrics = self._data
+        all_dates = np.union1d(old_dates, dates)
+        codes = list(old_index) + [code for code in series if code not in old_index]
+        if len(all_dates) == len(old_dates) and len(codes) == len(old_index) and self._stored(dates, series):
+            return False
+        index = {code: i for i, code in enumerate(codes)}
+        old_rows = np.searchsorted(all_dates, old_dates)
+        new_rows = np.searchsorted(all_dates, dates)
+        metrics = {}
+        for metric in self.METRICS:
+            values = np.zeros((len(all_dates), len(codes)), dtype=np.int64)
+            if len(old_index) > 0:
+                values[old_rows, :len(old_index)] = old_metrics[metric]
+                # carry the last values forward for countries missing in the new data
+                values[all_dates > old_dates[-1], :len(old_index)] = old_metrics[metric][-1]
+            for code, item in series.items():
+                values[new_rows, index[code]] = item[metric]
+                # countries first seen now keep their earliest value before, so that diffs show no jump
+                if code not in old_index and len(dates) > 0:
+                    values[:new_rows[0], index[code]] = item[metric][0]
+            metrics[metric] = values
+        self._save(all_dates, codes, metrics)
+        self._load()
+        return True
+
+    def _stored(self, dates, series):
+        # checks if all values of the given stored dates are equal to the stored values
+        stored_dates, index, metrics = self._data
+        rows = np.searchsorted(stored_dates, dates)
+        return all(
+            np.array_equal(metrics[metric][rows, index[code]], item[metric])
+            for code, item in series.items() for metric in self.METRICS
+        )
+
+    def series(self, code, days):
+        """Returns the dates and the cumulative values of each metric for the last `days` days of a country."""
+        dates, index, metrics = self._data
+        if code not in index:
+            return None
+        column = index[code]
+        return (dates[-days:], *(np.array(metrics[metric][-days:, column]) for metric in self.METRICS))
@@ -0,0 +1,146 @@
+from collections import defaultdict
+from os.path import exists
+from threading import RLock
+import json
+import logging
+import pickle
+import sqlite3
+
+from telegram.ext import BasePersistence
+
+logger = logging.getLogger(__name__)
+
+
+class SqlitePersistence(BasePersistence):
+    """A persistence backend storing one row per user, chat and conversation in a SQLite database.
+
+    Updates only mark records as changed. Changed records are written in a single transaction on flush(),
+    which should be called periodically, so the cost of a flush does not grow with the number of users.
+    """
+
+    def __init__(self, filename, migrate_from=None):
+        super().__init__(store_user_data=True, store_chat_data=True, store_bot_data=True)
+        self.filename = filename
+        self._lock = RLock()
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS user_data (id INTEGER PRIMARY KEY, data BLOB);
+            CREATE TABLE IF NOT EXISTS chat_data (id INTEGER PRIMARY KEY, data BLOB);
+            CREATE TABLE IF NOT EXISTS bot_data (id INTEGER PRIMARY KEY CHECK (id = 0), data BLOB);
+            CREATE TABLE IF NOT EXISTS conversations (name TEXT, key TEXT, state BLOB, PRIMARY KEY (name, key));
+        """)
+        self.user_data = self._load_table("user_data")
+        self.chat_data = self._load_table("chat_data")
+        row = self._connection.execute("SELECT data FROM bot_data").fetchone()
+        self.bot_data = pickle.loads(row[0]) if row else {}
+        self.conversations = defaultdict(dict)
+        for name, key, state in self._connection.execute("SELECT name, key, state FROM conversations"):
+            self.conversations[name][tuple(json.loads(key))] = pickle.loads(state)
+        # changed records, written on the next flush
+        self._dirty_users, self._dirty_chats, self._dirty_conversations = set(), set(), set()
+        self._dirty_bot_data = False
+        if migrate_from and exists(migrate_from) and not (self.user_data or self.chat_data or self.bot_data):
+            self._migrate(migrate_from)
+
+    def _load_table(self, table):
+        data = defaultdict(dict)
+        for record_id, blob in self._connection.execute("SELECT id, data FROM {}".format(table)):
+            data[record_id] = pickle.loads(blob)
+        return data
+
+    def _migrate(self, filename):
+        """Imports all data of a single-file PicklePersistence."""
+        with open(filename, "rb") as f:
+            data = pickle.load(f)
+        self.user_data.update(data.get("user_data", {}))
+        self.chat_data.update(data.get("chat_data", {}))
+        self.bot_data = data.get("bot_data", {})
+        for name, conversation in data.get("conversations", {}).items():
+            self.conversations[name].update(conversation)
+        self._dirty_users.update(self.user_data)
+        self._dirty_chats.update(self.chat_data)
+        self._dirty_bot_data = True
+        self._dirty_conversations.update(
+            (name, key) for name, conversation in self.conversations.items() for key in conversation
+        )
+        self.flush()
+        logger.info("Migrated {} users and {} chats from {}.".format(len(self.user_data), len(self.chat_data), filename))
+
+    def get_user_data(self):
+        return self.user_data
+
+    def get_chat_data(self):
+        return self.chat_data
+
+    def get_bot_data(self):
+        return self.bot_data
+
+    def get_conversations(self, name):
+        return self.conversations[name].copy()
+
+    def update_user_data(self, user_id, data):
+        with self._lock:
+            if self.user_data.get(user_id) == data:
+                return
+            self.user_data[user_id] = data
+            self._dirty_users.add(user_id)
+
+    def update_chat_data(self, chat_id, data):
+        with self._lock:
+            if self.chat_data.get(chat_id) == data:
+                return
+            self.chat_data[chat_id] = data
+            self._dirty_chats.add(chat_id)
+
+    def update_bot_data(self, data):
+        with self._lock:
+            if self.bot_data == data:
+                return
+            self.bot_data = data
+            self._dirty_bot_data = True
+
+    def update_conversation(self, name, key, new_state):
+        with self._lock:
+            if self.conversations[name].get(key) != new_state:
+                self.conversations[name][key] = new_state
+                self._dirty_conversations.add((name, key))
+
+    def flush(self):
+        """Writes all records changed since the last flush."""
+        with self._lock:
+            users, chats, conversations = self._dirty_users, self._dirty_chats, self._dirty_conversations
+            bot_data = self._dirty_bot_data
+            self._dirty_users, self._dirty_chats, self._dirty_conversations = set(), set(), set()
+            self._dirty_bot_data = False
+            try:
+                with self._connection:
+                    self._connection.executemany(
+                        "INSERT OR REPLACE INTO user_data VALUES (?, ?)",
+                        [(i, pickle.dumps(self.user_data[i])) for i in users],
+                    )
+                    self._connection.executemany(
+                        "INSERT OR REPLACE INTO chat_data VALUES (?, ?)",
+                        [(i, pickle.dumps(self.chat_data[i])) for i in chats],
+                    )
+                    if bot_data:
+                        self._connection.execute(
+                            "INSERT OR REPLACE INTO bot_data VALUES (0, ?)", (pickle.dumps(self.bot_data),)
+                        )
+                    for name, key in conversations:
+                        state = self.conversations[name].get(key)
+                        if state is None:
+                            self._connection.execute(
+                                "DELETE FROM conversations WHERE name = ? AND key = ?", (name, json.dumps(key))
+                            )
+                        else:
+                            self._connection.execute(
+                                "INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)",
+                                (name, json.dumps(key), pickle.dumps(state)),
+                            )
+            except (sqlite3.Error, pickle.PicklingError, RuntimeError):
+                # keep the records for the next flush, e.g. if a record was modified while being pickled
+                self._dirty_users |= users
+                self._dirty_chats |= chats
+                self._dirty_conversations |= conversations
+                self._dirty_bot_data |= bot_data
+                logger.warning("Failed to flush persistence.", exc_info=True)
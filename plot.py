@@ -1,67 +1,261 @@
-import io
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from datetime import timedelta
+from threading import BoundedSemaphore, Lock
+import hashlib
+import io
+import multiprocessing
 
 import numpy as np
 import matplotlib
-import matplotlib.pyplot as plt
+import matplotlib.style
+import matplotlib.dates as mdates
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from matplotlib.ticker import StrMethodFormatter
 
+from cache import LRUCache
+
 
 matplotlib.use("Agg")
 matplotlib.style.use("seaborn")
 
+# maximum number of bytes of rendered charts kept in memory
+CHART_CACHE_SIZE = 32 * 1024 * 1024
+
+_chart_cache = LRUCache(maxsize=CHART_CACHE_SIZE, getsizeof=len)
+# the data version of the most recently rendered chart per (kind, name)
+_chart_versions = {}
+
 
 def _moving_avg(data, days=7):
-    # Use 1d convolution for moving average, as explained in https://stackoverflow.com/a/22621523.
-    return np.convolve(data, np.ones(days) / days, mode="valid")
+    # Use differences of the cumulative sum for the moving average, which is O(n) in the length of the data.
+    cumsum = np.cumsum(np.insert(np.asarray(data, dtype=np.float64), 0, 0))
+    return (cumsum[days:] - cumsum[:-days]) / days
+
+
+class _Chart:
+    """A reusable chart template. The figure and all artists are created once and only updated per render.
+
+    As no pyplot state is used, figures are never leaked and memory stays bounded by the number of templates.
+    """
+
+    def __init__(self, ylabel, footer):
+        self.figure = Figure()
+        FigureCanvasAgg(self.figure)
+        self.ax = self.figure.subplots()
+        self.ax.xaxis_date()
+        self.ax.yaxis.set_major_formatter(StrMethodFormatter("{x:,.0f}"))
+        self.ax.tick_params(axis="x", labelrotation=30)
+        self.ax.set_ylabel(ylabel)
+        self.ax.text(0, 0, footer, fontsize=6, va="bottom", transform=self.ax.transAxes)
+        self.fills = {}
+        self.lock = Lock()
+
+    def _dates(self, last_date, n):
+        return mdates.date2num([last_date - timedelta(days=i) for i in range(n)][::-1])
+
+    def _fill(self, name, dates, values, color):
+        if name in self.fills:
+            self.fills[name].remove()
+        self.fills[name] = self.ax.fill_between(dates, values, color=color, alpha=0.5)
+
+    def _annotate(self, annotation, x, y):
+        annotation.xy = (x, y)
+        annotation.set_position((x, y))
+        annotation.set_text(round(y))
+
+    def _render(self, dates, title):
+        self.ax.set_title(title)
+        # fill areas are not included by relim(), so make sure the zero line stays visible
+        self.ax.relim()
+        self.ax.update_datalim([(dates[0], 0)])
+        self.ax.autoscale_view()
+        self.ax.set_xlim((dates[0], dates[-1]))
+        for label in self.ax.get_xticklabels():
+            label.set_horizontalalignment("right")
+        self.figure.tight_layout()
+        buffer = io.BytesIO()
+        self.figure.savefig(buffer, format="png")
+        buffer.seek(0)
+        return buffer
+
+
+class _TimeseriesChart(_Chart):
+    def __init__(self):
+        super().__init__("Cases (moving 7-day avg.)", "by @coronapandemicbot; data by JHUCSSE")
+        self.cases_line, = self.ax.plot([], [], ".-c", label="Infections")
+        self.deaths_line, = self.ax.plot([], [], ".-r", label="Deaths")
+        self.cases_label = self.ax.annotate("", (0, 0), ha="right", va="bottom", color="c")
+        self.deaths_label = self.ax.annotate("", (0, 0), ha="right", va="bottom", color="r")
+        self.ax.legend()
+
+    def render(self, data):
+        cases, deaths = _moving_avg(data["cases"]), _moving_avg(data["deaths"])
+        dates = self._dates(data["last_date"], len(cases))
+        with self.lock:
+            self.cases_line.set_data(dates, cases)
+            self._fill("cases", dates, cases, "c")
+            self.deaths_line.set_data(dates, deaths)
+            self._fill("deaths", dates, deaths, "r")
+            self._annotate(self.cases_label, dates[-1], cases[-1])
+            self._annotate(self.deaths_label, dates[-1], deaths[-1])
+            title = "New Covid-19 Cases in {} - {} Days".format(data["name"], len(cases))
+            return self._render(dates, title)
+
+
+class _VaccinationsChart(_Chart):
+    def __init__(self):
+        super().__init__("Vaccinations Doses (moving 7-day avg.)", "by @coronapandemicbot; data by ourworldindata.org.")
+        self.line, = self.ax.plot([], [], ".-g")
+        self.total = self.ax.text(0.01, 0.95, "", weight="bold", transform=self.ax.transAxes)
+
+    def render(self, data):
+        vaccinations = _moving_avg(data["vaccinations"])
+        dates = self._dates(data["last_date"], len(vaccinations))
+        with self.lock:
+            self.line.set_data(dates, vaccinations)
+            self._fill("vaccinations", dates, vaccinations, "g")
+            self.total.set_text(f"Total: {data['total']:,}")
+            title = "Daily Vaccination Doses in {} - {} Days".format(data["name"], len(vaccinations))
+            return self._render(dates, title)
+
+
+# chart templates are created lazily, so that each worker process has its own
+_templates = {}
+
+
+def _template(cls):
+    if cls not in _templates:
+        _templates[cls] = cls()
+    return _templates[cls]
 
 
 def plot_timeseries(data):
-    fig, ax = plt.subplots()
-    ax.yaxis.set_major_formatter(StrMethodFormatter("{x:,.0f}"))
-    cases, deaths = _moving_avg(data["cases"]), _moving_avg(data["deaths"])
-    dates = [data["last_date"] - timedelta(days=i) for i in range(len(cases))][::-1]
-    plt.plot(dates, cases, ".-c", label="Infections")
-    plt.fill_between(dates, cases, color="c", alpha=0.5)
-    plt.plot(dates, deaths, ".-r", label="Deaths")
-    plt.fill_between(dates, deaths, color="r", alpha=0.5)
-    plt.annotate(round(cases[-1]), (dates[-1], cases[-1]), ha="right", va="bottom", color="c")
-    plt.annotate(round(deaths[-1]), (dates[-1], deaths[-1]), ha="right", va="bottom", color="r")
-    plt.legend()
-    plt.xticks(rotation=30, ha="right")
-    plt.xlim((dates[0], dates[-1]))
-    plt.ylabel("Cases (moving 7-day avg.)")
-    plt.title("New Covid-19 Cases in {} - {} Days".format(data["name"], len(cases)))
-    plt.text(0, 0, "by @coronapandemicbot; data by JHUCSSE", fontsize=6, va="bottom", transform=ax.transAxes)
-    plt.tight_layout()
-    buffer = io.BytesIO()
-    plt.savefig(buffer, format="png")
-    buffer.seek(0)
-    plt.clf()
-    return buffer
+    return _template(_TimeseriesChart).render(data)
 
 
 def plot_vaccinations_series(data):
-    fig, ax = plt.subplots()
-    ax.yaxis.set_major_formatter(StrMethodFormatter("{x:,.0f}"))
-    vaccinations = _moving_avg(data["vaccinations"])
-    dates = [data["last_date"] - timedelta(days=i) for i in range(len(vaccinations))][::-1]
-    plt.plot(dates, vaccinations, ".-g")
-    plt.fill_between(dates, vaccinations, color="g", alpha=0.5)
-    plt.xticks(rotation=30, ha="right")
-    plt.xlim((dates[0], dates[-1]))
-    plt.ylabel("Vaccinations Doses (moving 7-day avg.)")
-    plt.title("Daily Vaccination Doses in {} - {} Days".format(data["name"], len(vaccinations)))
-    plt.text(0.01, 0.95, f"Total: {data['total']:,}", weight="bold", transform=ax.transAxes)
-    plt.text(
-        0, 0, "by @coronapandemicbot; data by ourworldindata.org.", fontsize=6, va="bottom", transform=ax.transAxes
-    )
-    plt.tight_layout()
-    buffer = io.BytesIO()
-    plt.savefig(buffer, format="png")
-    buffer.seek(0)
-    plt.clf()
-    return buffer
+    return _template(_VaccinationsChart).render(data)
+
+
+CHARTS = {
+    "cases": plot_timeseries,
+    "vacc": plot_vaccinations_series,
+}
+
+
+def data_version(data):
+    """Returns a digest identifying the given timeseries data."""
+    digest = hashlib.sha1()
+    for key in sorted(data):
+        value = data[key]
+        digest.update(key.encode())
+        if isinstance(value, (list, np.ndarray)):
+            digest.update(np.asarray(value).tobytes())
+        else:
+            digest.update(str(value).encode())
+    return digest.hexdigest()
+
+
+def _render(kind, data):
+    buffer = CHARTS[kind](data)
+    png = buffer.getvalue()
+    buffer.close()
+    return png
+
+
+class RenderError(Exception):
+    """Raised if a chart could not be rendered in time or its worker process crashed."""
+    pass
+
+
+class RenderQueueFull(RenderError):
+    pass
+
+
+class RenderService:
+    """Renders charts in a pool of worker processes, as rendering is CPU-bound and holds the GIL.
+
+    At most `max_pending` charts are queued or rendering at once, further requests raise RenderQueueFull.
+    If a worker crashes or a chart takes longer than `timeout` seconds, the pool is replaced by a new one.
+    """
+
+    def __init__(self, workers=2, max_pending=16, timeout=60):
+        self.workers = workers
+        self._slots = BoundedSemaphore(max_pending)
+        self._lock = Lock()
+        self.timeout = timeout
+        # workers are forked from a server process started without any threads, which has this module loaded,
+        # so pools can be created safely at any time
+        self._context = multiprocessing.get_context("forkserver")
+        self._context.set_forkserver_preload([__name__])
+        self._executor = self._create_executor()
+
+    def _create_executor(self):
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=self._context)
+
+    def _restart(self, old):
+        with self._lock:
+            if self._executor is not old:
+                return
+            self._executor = self._create_executor()
+        # a hung worker would never exit by itself, charts still rendering in the old pool fail
+        processes = list(old._processes.values()) if old._processes else []
+        old.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+
+    def submit(self, kind, data):
+        if not self._slots.acquire(blocking=False):
+            raise RenderQueueFull()
+        executor = self._executor
+        try:
+            future = executor.submit(_render, kind, data)
+        except BrokenProcessPool as ex:
+            self._slots.release()
+            self._restart(executor)
+            raise RenderError("The render pool was broken.") from ex
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def render(self, kind, data):
+        executor = self._executor
+        future = self.submit(kind, data)
+        try:
+            return future.result(self.timeout)
+        except TimeoutError as ex:
+            self._restart(executor)
+            raise RenderError("Rendering took longer than {} seconds.".format(self.timeout)) from ex
+        except BrokenProcessPool as ex:
+            self._restart(executor)
+            raise RenderError("A render worker crashed.") from ex
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+
+def render_chart(kind, data, service=None):
+    """Returns the png bytes of a chart of the given kind (one of CHARTS) for the data.
+
+    Rendered charts are cached until the underlying data changes. If a RenderService is given,
+    the chart is rendered by it, otherwise in the calling thread.
+    """
+    version = data_version(data)
+    key = (kind, data["name"], version)
+    png = _chart_cache.get(key)
+    if png is None:
+        png = service.render(kind, data) if service else _render(kind, data)
+        _chart_cache.set(key, png)
+        # drop the chart of the previous data version
+        previous = _chart_versions.get((kind, data["name"]))
+        if previous and previous != version:
+            _chart_cache.pop((kind, data["name"], previous))
+        _chart_versions[(kind, data["name"])] = version
+    return png
 
 
 if __name__ == "__main__":
@@ -1,20 +1,30 @@
 from os.path import dirname, join, basename
+from string import Formatter
 import glob
 import json
 
 _directory = dirname(__file__)
 _lang_dict = {}
 
+# returns the template of a string and whether it has any replacement fields
+def _compile(val):
+    if isinstance(val, list):
+        val = "\n".join(val)
+    if any(field is not None for _, field, _, _ in Formatter().parse(val)):
+        return val, True
+    # strings without fields are formatted once here
+    return val.format(), False
+
 # load all language files of form "strings.*.json"
 for path in glob.glob(join(_directory, "strings.*.json")):
     lang_code = basename(path).split(".")[1]
     with open(path, 'r', encoding="utf-8") as f:
-        _lang_dict[lang_code] = json.load(f)
+        _lang_dict[lang_code] = {key: _compile(val) for key, val in json.load(f).items()}
+
+# returns the given language if strings are available in it, otherwise the default language
+def language(lang):
+    return lang if lang in _lang_dict else "en"
 
 def resolve(key, lang, *args):
-    lang = lang if lang in _lang_dict else "en"
-    val = _lang_dict[lang][key]
-    if isinstance(val, list):
-        return "\n".join(val).format(*args)
-    else:
-        return val.format(*args)
+    template, has_fields = _lang_dict[language(lang)][key]
+    return template.format(*args) if has_fields else template
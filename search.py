@@ -0,0 +1,107 @@
+from bisect import bisect_left
+from collections import Counter, defaultdict
+import re
+import unicodedata
+
+
+class PrefixIndex:
+    """A sorted array of lower-case names, which finds all names starting with a prefix in logarithmic time."""
+
+    def __init__(self, names):
+        self._names = sorted(set(name.lower() for name in names))
+
+    def __len__(self):
+        return len(self._names)
+
+    def search(self, prefix, limit=None):
+        """Returns up to `limit` names starting with `prefix` in alphabetical order."""
+        prefix = prefix.lower()
+        results = []
+        i = bisect_left(self._names, prefix)
+        while i < len(self._names) and self._names[i].startswith(prefix):
+            if limit is not None and len(results) >= limit:
+                break
+            results.append(self._names[i])
+            i += 1
+        return results
+
+
+def normalize(name):
+    """Lower-cases a name and strips accents and punctuation, e.g. "España" becomes "espana"."""
+    name = unicodedata.normalize("NFKD", name.lower())
+    name = "".join(c for c in name if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[^\w]+", " ", name).split())
+
+
+def _trigrams(name):
+    padded = "  {} ".format(name)
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _edit_distance(a, b, limit):
+    """Returns the edit distance of a and b counting swapped adjacent letters as one edit,
+    or limit + 1 if it exceeds limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    before, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i]
+        for j in range(1, len(b) + 1):
+            distance = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                distance = min(distance, before[j - 2] + 1)
+            current.append(distance)
+        if min(current) > limit:
+            return limit + 1
+        before, previous = previous, current
+    return previous[-1]
+
+
+class NameResolver:
+    """Resolves names to values, tolerating differences in case, accents and punctuation as well as typos.
+
+    Exact matches of normalized names are looked up in a dict. Otherwise, candidates sharing trigrams
+    with the query are ranked and the best one within a length-dependent edit distance is returned.
+    """
+
+    # number of candidates with the most shared trigrams checked for their edit distance
+    CANDIDATES = 10
+
+    def __init__(self, names):
+        self._names = {}
+        self._trigrams = defaultdict(set)
+        for name, value in names.items():
+            name = normalize(name)
+            if name and name not in self._names:
+                self._names[name] = value
+                for trigram in _trigrams(name):
+                    self._trigrams[trigram].add(name)
+
+    def __len__(self):
+        return len(self._names)
+
+    def _max_distance(self, query):
+        if len(query) <= 4:
+            return 0
+        return 1 if len(query) <= 8 else 2
+
+    def resolve(self, query, fuzzy=True):
+        """Returns the value of the best matching name or None if no name is similar enough.
+
+        Without `fuzzy`, only names equal to the query after normalization are matched.
+        """
+        query = normalize(query)
+        if query in self._names:
+            return self._names[query]
+        limit = self._max_distance(query)
+        if not fuzzy or limit == 0:
+            return None
+        shared = Counter()
+        for trigram in _trigrams(query):
+            shared.update(self._trigrams.get(trigram, ()))
+        best, best_distance = None, limit + 1
+        for name, _ in shared.most_common(self.CANDIDATES):
+            distance = _edit_distance(query, name, limit)
+            if distance < best_distance:
+                best, best_distance = name, distance
+        return self._names[best] if best else None
@@ -1,26 +1,255 @@
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from os.path import exists
+import json
+import logging
 import math
+import os
+import re
+from threading import Lock
+from time import time
 
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from cache import LRUCache, TTLCache
+from circuit import CircuitBreaker, CircuitOpenError
+
+
+logger = logging.getLogger(__name__)
 
 BASE_URL = "https://disease.sh/v3/covid-19/"
 
+# connect and read timeouts (in seconds) of every request
+REQUEST_TIMEOUT = (5, 30)
+# number of connections kept alive and of requests made concurrently
+POOL_SIZE = 8
+
+# how long (in seconds) a failed request is not repeated
+FAILURE_TTL = 60
+
+# how long (in seconds) responses of an endpoint are cached, the longest matching prefix wins
+CACHE_TTLS = {
+    "": 10 * 60,
+    "historical": 60 * 60,
+    "vaccine": 60 * 60,
+    "gov/de": 30 * 60,
+}
+
+# orders in which country rankings are available
+SORT_ORDERS = [
+    'cases', 'deaths',
+    'casesPerOneMillion', 'deathsPerOneMillion',
+    'todayCases', 'todayDeaths',
+    'vaccinations',
+]
+
+# number of days shown in timeseries by default
+DEFAULT_DAYS = 36
+
+# how often (in seconds) the snapshot of all countries is rebuilt
+SNAPSHOT_INTERVAL = 10 * 60
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not math.isnan(value)
+
+
+def _timeline_arrays(*timelines):
+    """Converts timelines of the form {"m/d/yy": value} sharing the same dates into arrays sorted by date.
+
+    Returns the date axis (as datetime64[D]) followed by one array of values per timeline.
+    """
+    keys = list(timelines[0])
+    months, days, years = np.array([key.split("/") for key in keys], dtype=np.int64).reshape(-1, 3).T
+    dates = (np.datetime64("2000-01", "M") + (years * 12 + months - 1).astype("timedelta64[M]")).astype("datetime64[D]")
+    dates += (days - 1).astype("timedelta64[D]")
+    order = np.argsort(dates, kind="stable")
+    values = [np.array([timeline[key] for key in keys], dtype=np.int64)[order] for timeline in timelines]
+    return (dates[order], *values)
+
+
+def _to_datetime(date):
+    return date.astype("datetime64[s]").item()
+
 
 class CovidApi:
     """A simple wrapper for the COVID-19 disease.sh API (https://github.com/disease-sh/API)."""
 
-    def __init__(self):
-        self.countries = self._all_countries()
-        self.name_map = self._build_name_map(self.countries)
-        self.us_states = self._all_us_states()
-        self.de_states = self._all_de_states()
+    def __init__(self, cache=None, history=None, metadata_file=None, serve_stale=True):
+        # any object with get(key) and set(key, value, ttl) can be used as response cache
+        self.cache = cache if cache is not None else TTLCache(maxsize=256)
+        # an optional HistoryStore from which country timeseries are served
+        self.history = history
+        self.session = self._create_session()
+        # stops requests while disease.sh is down, the last good response of each request is served instead
+        self._circuit = CircuitBreaker("disease.sh")
+        self._failures = TTLCache(maxsize=256, ttl=FAILURE_TTL)
+        self._stale = LRUCache(maxsize=256)
+        # with `serve_stale`, expired data is returned immediately and refreshed in the background
+        self.serve_stale = serve_stale
+        self._pending = set()
+        self._pending_lock = Lock()
+        self._executor = ThreadPoolExecutor(max_workers=POOL_SIZE)
+        self._snapshot = {}
+        self._rankings = {}
+        self._snapshot_time = 0
+        self._snapshot_lock = Lock()
+        # timeseries arrays converted from cached responses
+        self._series = LRUCache(maxsize=256)
+        # states of the US and Germany by lower-case name, built from the bulk response of each region
+        self._state_indexes = {}
+        # unix timestamp of the last successful call to refresh()
+        self.last_refreshed = None
+        # country and state names are loaded from `metadata_file` if possible and refreshed in the background
+        self.metadata_file = metadata_file
+        self.countries, self.name_map, self.command_map = {}, {}, {}
+        self.us_states, self.de_states = [], []
+        if self._load_metadata():
+            self._executor.submit(self.refresh_metadata)
+        else:
+            self.refresh_metadata()
+
+    def _load_metadata(self):
+        if not self.metadata_file or not exists(self.metadata_file):
+            return False
+        try:
+            with open(self.metadata_file, "r", encoding="utf-8") as f:
+                metadata = json.load(f)
+            self._set_countries(metadata["countries"])
+            self.us_states = metadata["us_states"]
+            self.de_states = metadata["de_states"]
+            return True
+        except (OSError, ValueError, KeyError):
+            logger.warning("Failed to load metadata from {}.".format(self.metadata_file), exc_info=True)
+            return False
+
+    def _save_metadata(self):
+        metadata = {"countries": self.countries, "us_states": self.us_states, "de_states": self.de_states}
+        with open(self.metadata_file + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(metadata, f)
+        os.replace(self.metadata_file + ".tmp", self.metadata_file)
+
+    def refresh_metadata(self):
+        """Fetches the names of all countries and states concurrently. Returns True if all were updated."""
+        futures = [self._executor.submit(f) for f in [self._all_countries, self._all_us_states, self._all_de_states]]
+        countries, us_states, de_states = [future.result() for future in futures]
+        if countries:
+            self._set_countries(countries)
+        self.us_states = us_states or self.us_states
+        self.de_states = de_states or self.de_states
+        success = bool(countries and us_states and de_states)
+        if success and self.metadata_file:
+            self._save_metadata()
+        return success
 
     def _clean(self, s):
         s = s.replace("\xad", "")
         s = s.replace("\n", "")
         return s
 
+    def _create_session(self):
+        # failed requests are retried with exponential backoff
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"])
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=retry)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def _ttl(self, path):
+        prefix = max((p for p in CACHE_TTLS if path.startswith(p)), key=len)
+        return CACHE_TTLS[prefix]
+
+    def _get(self, path, params=None, refresh=False, ttl=None):
+        """Returns the decoded JSON response of an endpoint or None if the request failed.
+
+        Successful responses are cached, so the returned data must not be modified.
+        If the request fails, the last successful response is returned instead, if there is one.
+        With `refresh`, the cache is bypassed and updated with a fresh response, which is never stale.
+        """
+        key = (path, tuple(sorted(params.items())) if params else ())
+        data = None if refresh else self.cache.get(key)
+        if data is None:
+            stale = None if refresh else self._stale.get(key)
+            if stale is not None and self.serve_stale:
+                self._in_background(key, self._load, key, path, params, False, ttl)
+                return stale
+            data = self._load(key, path, params, refresh, ttl)
+            if data is None:
+                return stale
+        return data
+
+    def _load(self, key, path, params, refresh, ttl):
+        data = self._request(key, path, params=params, refresh=refresh)
+        if data is not None:
+            self.cache.set(key, data, ttl=max(self._ttl(path), ttl or 0))
+            self._stale.set(key, data)
+        return data
+
+    def _in_background(self, key, func, *args):
+        """Runs func on the executor, unless a call with the same key is already pending."""
+        with self._pending_lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+
+        def run():
+            try:
+                func(*args)
+            except Exception:
+                logger.warning("Background refresh of {} failed.".format(key), exc_info=True)
+            finally:
+                with self._pending_lock:
+                    self._pending.discard(key)
+
+        self._executor.submit(run)
+
+    def _request(self, key, path, params=None, refresh=False):
+        """Fetches an endpoint unless it failed recently or disease.sh is down. Returns None if it failed."""
+        if not refresh and self._failures.get(key):
+            return None
+        try:
+            if refresh:
+                # refreshes are never skipped, but their outcome still opens or closes the circuit
+                data = self._fetch(path, params=params)
+                self._circuit.record(True)
+            else:
+                data = self._circuit.call(self._fetch, path, params=params)
+        except CircuitOpenError:
+            return None
+        except (requests.RequestException, ValueError) as ex:
+            if refresh:
+                self._circuit.record(False)
+            logger.warning("Request to {} failed: {}".format(path, ex))
+            data = None
+        if data is None:
+            self._failures.set(key, True)
+        return data
+
+    def _fetch(self, path, params=None):
+        response = self.session.get(BASE_URL + path, params=params, timeout=REQUEST_TIMEOUT)
+        if response.status_code == 200:
+            return response.json()
+        else:
+            return None
+
+    def _set_countries(self, countries):
+        self.countries = countries
+        self.name_map = self._build_name_map(countries)
+        self.command_map = self._build_command_map(countries)
+
+    def _build_command_map(self, countries):
+        # maps the bot commands of all countries (iso2 and iso3 codes and normalized name) to their codes
+        command_map = {}
+        for iso2, country in countries.items():
+            command_map[iso2.lower()] = iso2
+            if country["iso3"]:
+                command_map[country["iso3"].lower()] = iso2
+            command_map[re.sub(r"[^a-z]", "_", country["name"].lower())] = iso2
+        return command_map
+
     def _build_name_map(self, countries):
         name_map = {}
         for iso2, country in countries.items():
@@ -30,122 +259,247 @@ class CovidApi:
         return name_map
 
     def _all_countries(self):
-        response = requests.get(BASE_URL + "countries")
-        if response.status_code == 200:
+        data = self._get("countries")
+        if data is not None:
             countries = {}
-            for item in response.json():
+            for item in data:
                 iso2 = item["countryInfo"]["iso2"]
                 if iso2:
-                    countries[iso2] = item["countryInfo"]
-                    countries[iso2]["name"] = item["country"]
+                    countries[iso2] = dict(item["countryInfo"], name=item["country"])
             return countries
         else:
             return {}
 
     def _all_us_states(self):
-        response = requests.get(BASE_URL + "states")
-        if response.status_code == 200:
-            countries = []
-            for item in response.json():
-                countries.append(item["state"])
-            return countries
-        else:
-            return []
+        return [item["state"] for item in self._us_states_index().values()]
 
     def _all_de_states(self):
-        response = requests.get(BASE_URL + "gov/de")
-        if response.status_code == 200:
-            countries = []
-            for item in response.json():
-                if item["province"].lower() != "total":
-                    countries.append(self._clean(item["province"]))
-            return countries
+        return [self._clean(item["province"]) for item in self._de_states_index().values()]
+
+    def _state_index(self, path, build):
+        """Returns the index built from the bulk response of a region, rebuilding it only if the response changed."""
+        data = self._get(path)
+        cached = self._state_indexes.get(path)
+        if data is None:
+            return cached[1] if cached else {}
+        if cached is None or cached[0] is not data:
+            cached = (data, build(data))
+            self._state_indexes[path] = cached
+        return cached[1]
+
+    def _us_states_index(self):
+        def build(data):
+            index = {}
+            for item in data:
+                # additions to unify format with countries
+                index[item["state"].lower()] = dict(item, recovered=item["cases"] - item["active"] - item["deaths"])
+            return index
+        return self._state_index("states", build)
+
+    def _de_states_index(self):
+        def build(data):
+            index = {}
+            for item in data:
+                name = self._clean(item["province"]).lower()
+                if name != "total":
+                    index[name] = item
+            return index
+        return self._state_index("gov/de", build)
+
+    def _series_arrays(self, data, *fields):
+        """Returns the date axis and value arrays of a historical response, converting each response only once."""
+        key = (id(data), fields)
+        cached = self._series.get(key)
+        # the response is kept with the arrays, so that its id is not reused while cached
+        if cached is None or cached[0] is not data:
+            timelines = [data[field] for field in fields] if fields else [data]
+            cached = (data, _timeline_arrays(*timelines))
+            self._series.set(key, cached)
+        return cached[1]
+
+    def refresh_countries(self):
+        """Rebuilds the snapshot of all countries from one bulk cases and one bulk vaccinations request."""
+        vacc = self._executor.submit(self._get, "vaccine/coverage/countries", params={"lastdays": 2})
+        items = self._get("countries")
+        if items is None:
+            return False
+        snapshot = {}
+        for item in items:
+            iso2 = item["countryInfo"]["iso2"]
+            if iso2:
+                snapshot[iso2] = dict(item, vaccinations=math.nan, todayVaccinations=math.nan)
+        for item in vacc.result() or []:
+            country_code = self.name_map.get(item["country"].lower())
+            if country_code in snapshot and item["timeline"]:
+                _, values = _timeline_arrays(item["timeline"])
+                snapshot[country_code]["vaccinations"] = int(values[-1])
+                if len(values) > 1:
+                    snapshot[country_code]["todayVaccinations"] = int(values[-1] - values[-2])
+        rankings = {}
+        for order in SORT_ORDERS:
+            # countries without a value for this order are left out of the ranking
+            ranked = [item for item in snapshot.values() if _is_number(item.get(order))]
+            rankings[order] = sorted(ranked, key=lambda c: c[order], reverse=True)
+        self._rankings = rankings
+        self._snapshot = snapshot
+        self._snapshot_time = time()
+        return True
+
+    def _refresh_snapshot(self):
+        with self._snapshot_lock:
+            if time() - self._snapshot_time > SNAPSHOT_INTERVAL:
+                self.refresh_countries()
+
+    def _country_snapshot(self):
+        if time() - self._snapshot_time > SNAPSHOT_INTERVAL:
+            if self._snapshot and self.serve_stale:
+                self._in_background("snapshot", self._refresh_snapshot)
+            else:
+                self._refresh_snapshot()
+        return self._snapshot
+
+    def refresh_history(self):
+        """Merges the days missing in the history store from one bulk request for all countries.
+
+        If the store is empty, the full history is requested. The store only writes if any value changed.
+        """
+        if self.history is None:
+            return True
+        if self.history.last_date is None:
+            lastdays = "all"
         else:
-            return []
+            # request a few more days, as the latest values are sometimes corrected
+            lastdays = int((np.datetime64("today", "D") - self.history.last_date).astype(int)) + 3
+        params = {"lastdays": lastdays}
+        items = self._request(("historical", tuple(params.items())), "historical", params=params, refresh=True)
+        if not items:
+            return False
+        dates, series, unknown = None, {}, set()
+        for item in items:
+            # the payload contains one item per province, which are summed up per country
+            country_code = self.name_map.get(item["country"].lower())
+            if not country_code:
+                unknown.add(item["country"])
+                continue
+            item_dates, cases, deaths = _timeline_arrays(item["timeline"]["cases"], item["timeline"]["deaths"])
+            if dates is None:
+                dates = item_dates
+            if country_code in series:
+                series[country_code]["cases"] += cases
+                series[country_code]["deaths"] += deaths
+            else:
+                series[country_code] = {"cases": cases, "deaths": deaths}
+        if unknown:
+            # these countries are requested separately by timeseries()
+            logger.info("Countries missing in the history store: {}".format(", ".join(sorted(unknown))))
+        if not series:
+            return False
+        self.history.update(dates, series)
+        return True
+
+    def refresh(self, ttl=None):
+        """Fetches all datasets served by this class, so that subsequent calls can be answered from the cache.
+
+        Fresh responses are kept for at least `ttl` seconds. Returns True if all datasets were updated.
+        """
+        prefetch = [
+            ("all", None),
+            ("countries", None),
+            ("states", None),
+            ("gov/de", None),
+            ("historical/all", {"lastdays": DEFAULT_DAYS + 1}),
+            ("vaccine/coverage", {"lastdays": 1}),
+            ("vaccine/coverage", {"lastdays": DEFAULT_DAYS + 1}),
+            ("vaccine/coverage/countries", {"lastdays": 2}),
+        ]
+        success = True
+        futures = [self._executor.submit(self._get, path, params=params, refresh=True, ttl=ttl) for path, params in prefetch]
+        for future in futures:
+            success &= future.result() is not None
+        self._us_states_index()
+        self._de_states_index()
+        success &= self.refresh_metadata()
+        with self._snapshot_lock:
+            success &= self.refresh_countries()
+        success &= self.refresh_history()
+        if success:
+            self.last_refreshed = time()
+        return success
 
     def cases_world(self, include_vaccinations=True):
-        response = requests.get(BASE_URL + "all")
-        if response.status_code == 200:
-            data = response.json()
+        if include_vaccinations:
+            vacc = self._executor.submit(self.vaccinations_world)
+        data = self._get("all")
+        if data is not None:
+            data = dict(data)
             if include_vaccinations:
-                vacc = self.vaccinations_world()
+                vacc = vacc.result()
                 data["vaccinations"] = vacc["vaccinations"] if vacc else math.nan
             return data
         else:
             return None
 
-    def cases_country_list(self, sort_by="cases"):
-        response = requests.get(BASE_URL + "countries", params={"sort": sort_by})
-        if response.status_code == 200:
-            return [item for item in response.json() if item["countryInfo"]["iso2"]]
-        else:
-            return []
+    def country_ranking(self, order="cases"):
+        """Returns all countries sorted descending by the given order (one of SORT_ORDERS).
+
+        The ranking is precomputed on every snapshot refresh, so slicing it is cheap.
+        """
+        self._country_snapshot()
+        return self._rankings.get(order, [])
 
     def cases_country(self, country, include_vaccinations=True):
         country_code = self.name_map[country.lower()]
-        response = requests.get(BASE_URL + "countries/{}".format(country_code))
-        if response.status_code == 200:
-            data = response.json()
-            del data["countryInfo"]
-            if include_vaccinations:
-                vacc = self.vaccinations_country(country)
-                data["vaccinations"] = vacc["vaccinations"] if vacc else math.nan
+        item = self._country_snapshot().get(country_code)
+        if item is not None:
+            data = {k: v for k, v in item.items() if k not in ["countryInfo", "todayVaccinations"]}
+            if not include_vaccinations:
+                del data["vaccinations"]
             return data
         else:
             return None
 
     def cases_us_state(self, state):
-        response = requests.get(BASE_URL + "states/{}".format(state))
-        if response.status_code == 200:
-            data = response.json()
-            # additions to unify format with countries
-            data["recovered"] = data["cases"] - data["active"] - data["deaths"]
-            return data
-        else:
-            return None
+        return self._us_states_index().get(state.lower())
 
     def cases_de_state(self, state):
-        response = requests.get(BASE_URL + "gov/de")
-        if response.status_code == 200:
-            data = response.json()
-            filtered = [item for item in data if self._clean(item["province"].lower()) == state.lower()]
-            return filtered[0] if len(filtered) > 0 else None
-        else:
-            return None
+        return self._de_states_index().get(self._clean(state).lower())
 
-    def timeseries(self, country=None, days=36):
+    def timeseries(self, country=None, days=DEFAULT_DAYS):
+        if country and self.history is not None:
+            country_code = self.name_map[country.lower()]
+            if country_code in self.history:
+                dates, cases, deaths = self.history.series(country_code, days + 1)
+                return {
+                    "name": self.countries[country_code]["name"],
+                    "last_date": _to_datetime(dates[-1]),
+                    "cases": np.diff(cases),
+                    "deaths": np.diff(deaths),
+                }
         # we always request one additional day to be able to calculate diffs
         if not country:
-            response = requests.get(BASE_URL + "historical/all", params={"lastdays": days + 1})
+            data = self._get("historical/all", params={"lastdays": days + 1})
         else:
             country_code = self.name_map[country.lower()]
-            response = requests.get(BASE_URL + "historical/{}".format(country_code), params={"lastdays": days + 1})
-        if response.status_code == 200:
-            data = response.json()
+            data = self._get("historical/{}".format(country_code), params={"lastdays": days + 1})
+        if data is not None:
             if "timeline" in data:  # if for a specific country
                 name = data["country"]
                 data = data["timeline"]
             else:
                 name = "the World"
-            sorted_dates = sorted(data["cases"], key=lambda s: datetime.strptime(s, "%m/%d/%y"))
-            cases, deaths = [], []
-            for i in range(1, len(sorted_dates)):
-                today, yesterday = sorted_dates[i], sorted_dates[i - 1]
-                cases.append(data["cases"][today] - data["cases"][yesterday])
-                deaths.append(data["deaths"][today] - data["deaths"][yesterday])
+            dates, cases, deaths = self._series_arrays(data, "cases", "deaths")
             return {
                 "name": name,
-                "last_date": datetime.strptime(sorted_dates[-1], "%m/%d/%y"),
-                "cases": cases,
-                "deaths": deaths,
+                "last_date": _to_datetime(dates[-1]),
+                "cases": np.diff(cases)[-days:],
+                "deaths": np.diff(deaths)[-days:],
             }
         else:
             return None
 
     def vaccinations_world(self):
-        response = requests.get(BASE_URL + "vaccine/coverage", params={"lastdays": 1})
-        if response.status_code == 200:
-            data = response.json()
+        data = self._get("vaccine/coverage", params={"lastdays": 1})
+        if data is not None:
             return {
                 "vaccinations": list(data.values())[0]
             }
@@ -154,61 +508,34 @@ class CovidApi:
 
     def vaccinations_country(self, country):
         country_code = self.name_map[country.lower()]
-        response = requests.get(BASE_URL + "vaccine/coverage/countries/{}".format(country_code), params={"lastdays": 1})
-        if response.status_code == 200:
-            data = response.json()
+        item = self._country_snapshot().get(country_code)
+        if item is not None and not math.isnan(item["vaccinations"]):
             return {
-                "country": data["country"],
-                "vaccinations": list(data["timeline"].values())[0]
+                "country": item["country"],
+                "vaccinations": item["vaccinations"]
             }
         else:
             return None
 
-    def vaccinations_country_list(self, sort_by="vaccinations"):
-        response = requests.get(BASE_URL + "vaccine/coverage/countries", params={"lastdays": 2})
-        if response.status_code == 200:
-            country_list = []
-            for item in response.json():
-                # try to mimic the output format of cases list
-                if item["country"].lower() in self.name_map:
-                    values = sorted(item["timeline"].items(), key=lambda s: datetime.strptime(s[0], "%m/%d/%y"))
-                    vaccinations = values[1][1]
-                    todayVaccinations = values[1][1] - values[0][1]
-                    data = {
-                        "country": item["country"],
-                        "vaccinations": vaccinations,
-                        "todayVaccinations": todayVaccinations,
-                        "countryInfo": {"iso2": self.name_map[item["country"].lower()]}
-                    }
-                    country_list.append(data)
-            return sorted(country_list, key=lambda c: c[sort_by], reverse=True)
-        else:
-            return []
-
-    def vaccinations_series(self, country=None, days=36):
+    def vaccinations_series(self, country=None, days=DEFAULT_DAYS):
         # we always request one additional day to be able to calculate diffs
         if not country:
-            response = requests.get(BASE_URL + "vaccine/coverage", params={"lastdays": days + 1})
+            data = self._get("vaccine/coverage", params={"lastdays": days + 1})
         else:
             country_code = self.name_map[country.lower()]
-            response = requests.get(BASE_URL + "vaccine/coverage/countries/{}".format(country_code), params={"lastdays": days + 1})
-        if response.status_code == 200:
-            data = response.json()
+            data = self._get("vaccine/coverage/countries/{}".format(country_code), params={"lastdays": days + 1})
+        if data is not None:
             if "timeline" in data:  # if for a specific country
                 name = data["country"]
                 data = data["timeline"]
             else:
                 name = "the World"
-            sorted_dates = sorted(data, key=lambda s: datetime.strptime(s, "%m/%d/%y"))
-            vaccinations = []
-            for i in range(1, len(sorted_dates)):
-                today, yesterday = sorted_dates[i], sorted_dates[i - 1]
-                vaccinations.append(data[today] - data[yesterday])
+            dates, vaccinations = self._series_arrays(data)
             return {
                 "name": name,
-                "last_date": datetime.strptime(sorted_dates[-1], "%m/%d/%y"),
-                "vaccinations": vaccinations,
-                "total": data[sorted_dates[-1]],
+                "last_date": _to_datetime(dates[-1]),
+                "vaccinations": np.diff(vaccinations)[-days:],
+                "total": int(vaccinations[-1]),
             }
         else:
             return None
@@ -0,0 +1,112 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from telegram.error import RetryAfter, Unauthorized
+
+from broadcast import Broadcaster, TokenBucket
+
+
+class FakeClock:
+    """Replaces monotonic() and sleep() of the broadcast module, sleeping only advances the time."""
+
+    def __init__(self, test):
+        self.time = 0
+        for name, func in [("monotonic", lambda: self.time), ("sleep", self.sleep)]:
+            patcher = mock.patch("broadcast." + name, func)
+            patcher.start()
+            test.addCleanup(patcher.stop)
+
+    def sleep(self, seconds):
+        self.time += seconds
+
+
+class TokenBucketTest(unittest.TestCase):
+    # rates are powers of two, so that the fake time stays exact
+
+    def setUp(self):
+        self.clock = FakeClock(self)
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=8, capacity=4)
+        for _ in range(4):
+            bucket.acquire()
+        self.assertEqual(self.clock.time, 0)
+        for _ in range(8):
+            bucket.acquire()
+        self.assertEqual(self.clock.time, 1)
+
+    def test_refills_up_to_capacity(self):
+        bucket = TokenBucket(rate=8, capacity=4)
+        self.clock.time = 100
+        for _ in range(4):
+            bucket.acquire()
+        self.assertEqual(self.clock.time, 100)
+        bucket.acquire()
+        self.assertEqual(self.clock.time, 100.125)
+
+    def test_pause(self):
+        bucket = TokenBucket(rate=8)
+        bucket.pause(3)
+        bucket.acquire()
+        # the bucket is empty after the pause
+        self.assertEqual(self.clock.time, 3.125)
+
+
+class FakeBot:
+
+    def __init__(self, errors=None):
+        # exceptions raised for the next messages to a chat
+        self.errors = errors or {}
+        self.sent = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        if self.errors.get(chat_id):
+            raise self.errors[chat_id].pop(0)
+        self.sent.append(chat_id)
+
+
+class BroadcasterTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeClock(self)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filename = os.path.join(directory.name, "database.sqlite")
+
+    def broadcaster(self, bot):
+        broadcaster = Broadcaster(bot, self.filename, workers=2)
+        self.addCleanup(broadcaster._connection.close)
+        return broadcaster
+
+    def test_send(self):
+        bot = FakeBot()
+        broadcaster = self.broadcaster(bot)
+        self.assertEqual(broadcaster.send("daily", [(1, "a"), (2, "b")]), 2)
+        self.assertEqual(sorted(bot.sent), [1, 2])
+        self.assertEqual(broadcaster.unfinished(), [])
+        # a finished broadcast is not sent again
+        self.assertEqual(broadcaster.send("daily", [(1, "a"), (2, "b")]), 0)
+
+    def test_forbidden_chats(self):
+        bot = FakeBot({2: [Unauthorized("Forbidden: bot was blocked by the user")]})
+        forbidden = []
+        self.assertEqual(self.broadcaster(bot).send("daily", [(1, "a"), (2, "b")], on_forbidden=forbidden.append), 1)
+        self.assertEqual(forbidden, [2])
+
+    def test_flood_limit_leaves_broadcast_unfinished(self):
+        bot = FakeBot({2: [RetryAfter(1) for _ in range(Broadcaster.MAX_RETRIES)]})
+        broadcaster = self.broadcaster(bot)
+        with self.assertLogs("broadcast", level="WARNING"):
+            self.assertEqual(broadcaster.send("daily", [(1, "a"), (2, "b")]), 1)
+        self.assertEqual(broadcaster.unfinished(), ["daily"])
+        # resuming only sends to the remaining chat
+        broadcaster = self.broadcaster(bot)
+        self.assertEqual(broadcaster.send("daily", [(1, "a"), (2, "b")]), 1)
+        self.assertEqual(bot.sent, [1, 2])
+        self.assertEqual(broadcaster.unfinished(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
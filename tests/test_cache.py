@@ -0,0 +1,79 @@
+import unittest
+
+from cache import LRUCache, TTLCache
+
+
+class FakeTimer:
+    def __init__(self):
+        self.time = 0
+
+    def __call__(self):
+        return self.time
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(len(cache), 2)
+
+    def test_bounded_by_size(self):
+        cache = LRUCache(maxsize=10, getsizeof=len)
+        cache.set("a", b"12345")
+        cache.set("b", b"123456")
+        self.assertNotIn("a", cache)
+        self.assertEqual(cache.currsize, 6)
+        # values larger than the cache are not stored
+        cache.set("c", b"12345678901")
+        self.assertNotIn("c", cache)
+        self.assertIn("b", cache)
+
+    def test_replace_and_pop(self):
+        cache = LRUCache(maxsize=10, getsizeof=len)
+        cache.set("a", b"123")
+        cache.set("a", b"12")
+        self.assertEqual(cache.currsize, 2)
+        self.assertEqual(cache.pop("a"), b"12")
+        self.assertEqual(cache.currsize, 0)
+        self.assertEqual(cache.pop("a", "default"), "default")
+
+    def test_stats(self):
+        cache = LRUCache()
+        cache.set("a", 1)
+        cache.get("a")
+        cache.get("b")
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["size"]), (1, 1, 1))
+
+
+class TTLCacheTest(unittest.TestCase):
+
+    def test_entries_expire(self):
+        timer = FakeTimer()
+        cache = TTLCache(maxsize=10, ttl=10, timer=timer)
+        cache.set("a", 1)
+        cache.set("b", 2, ttl=20)
+        timer.time = 10
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), 2)
+        self.assertEqual(len(cache), 1)
+        timer.time = 20
+        self.assertIsNone(cache.get("b"))
+
+    def test_evicts_least_recently_used(self):
+        cache = TTLCache(maxsize=1, timer=FakeTimer())
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+from unittest import mock
+
+from circuit import CircuitBreaker, CircuitOpenError
+
+
+def fail():
+    raise ValueError("upstream failed")
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.time = 0
+        patcher = mock.patch("circuit.monotonic", lambda: self.time)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.circuit = CircuitBreaker("test", failure_threshold=3, reset_timeout=10)
+
+    def open_circuit(self):
+        for _ in range(3):
+            with self.assertRaises(ValueError):
+                self.circuit.call(fail)
+
+    def test_opens_after_consecutive_failures(self):
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                self.circuit.call(fail)
+        self.assertFalse(self.circuit.is_open)
+        with self.assertRaises(ValueError):
+            self.circuit.call(fail)
+        self.assertTrue(self.circuit.is_open)
+        func = mock.Mock()
+        with self.assertRaises(CircuitOpenError):
+            self.circuit.call(func)
+        func.assert_not_called()
+
+    def test_success_resets_failures(self):
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                self.circuit.call(fail)
+        self.assertEqual(self.circuit.call(lambda: 1), 1)
+        with self.assertRaises(ValueError):
+            self.circuit.call(fail)
+        self.assertFalse(self.circuit.is_open)
+
+    def test_trial_call_closes_circuit(self):
+        self.open_circuit()
+        self.time = 10
+        self.assertEqual(self.circuit.call(lambda: 1), 1)
+        self.assertFalse(self.circuit.is_open)
+        self.assertEqual(self.circuit.failures, 0)
+
+    def test_failed_trial_call_reopens_circuit(self):
+        self.open_circuit()
+        self.time = 10
+        with self.assertRaises(ValueError):
+            self.circuit.call(fail)
+        self.assertTrue(self.circuit.is_open)
+        # the reset timeout starts again from the failed trial
+        self.time = 15
+        with self.assertRaises(CircuitOpenError):
+            self.circuit.call(lambda: 1)
+
+    def test_only_one_trial_call(self):
+        self.open_circuit()
+        self.time = 10
+        self.assertTrue(self.circuit._allow())
+        self.assertFalse(self.circuit._allow())
+
+    def test_record_outside_call(self):
+        self.open_circuit()
+        self.circuit.record(True)
+        self.assertFalse(self.circuit.is_open)
+        for _ in range(3):
+            self.circuit.record(False)
+        self.assertTrue(self.circuit.is_open)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from history import HistoryStore
+from statistics_api import CovidApi
+
+
+def days(start, count):
+    return np.arange(np.datetime64(start), np.datetime64(start) + count)
+
+
+def series(cases, deaths):
+    return {"cases": np.array(cases), "deaths": np.array(deaths)}
+
+
+class HistoryStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = directory.name
+
+    def test_update_and_reload(self):
+        store = HistoryStore(self.path)
+        self.assertIsNone(store.last_date)
+        self.assertTrue(store.update(days("2021-01-01", 3), {"DE": series([1, 2, 3], [0, 0, 1])}))
+        store = HistoryStore(self.path)
+        self.assertIn("DE", store)
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store.last_date, np.datetime64("2021-01-03"))
+        dates, cases, deaths = store.series("DE", 2)
+        np.testing.assert_array_equal(dates, days("2021-01-02", 2))
+        np.testing.assert_array_equal(cases, [2, 3])
+        np.testing.assert_array_equal(deaths, [0, 1])
+        self.assertIsNone(store.series("FR", 2))
+
+    def test_merge_overwrites_and_carries_forward(self):
+        store = HistoryStore(self.path)
+        store.update(days("2021-01-01", 3), {"DE": series([1, 2, 3], [0, 0, 1]), "FR": series([5, 6, 7], [1, 1, 1])})
+        store.update(days("2021-01-03", 2), {"DE": series([4, 5], [1, 2])})
+        _, cases, _ = store.series("DE", 4)
+        np.testing.assert_array_equal(cases, [1, 2, 4, 5])
+        # countries missing in the new data keep their last value
+        _, cases, _ = store.series("FR", 4)
+        np.testing.assert_array_equal(cases, [5, 6, 7, 7])
+
+    def test_new_country_is_backfilled_with_its_earliest_value(self):
+        store = HistoryStore(self.path)
+        store.update(days("2021-01-01", 3), {"DE": series([1, 2, 3], [0, 0, 1])})
+        store.update(days("2021-01-03", 2), {"DE": series([3, 4], [1, 1]), "FR": series([100, 110], [5, 6])})
+        _, cases, deaths = store.series("FR", 4)
+        np.testing.assert_array_equal(cases, [100, 100, 100, 110])
+        np.testing.assert_array_equal(deaths, [5, 5, 5, 6])
+
+    def test_unchanged_update_is_not_written(self):
+        store = HistoryStore(self.path)
+        store.update(days("2021-01-01", 3), {"DE": series([1, 2, 3], [0, 0, 1])})
+        modified = os.path.getmtime(os.path.join(self.path, "cases.npy"))
+        self.assertFalse(store.update(days("2021-01-02", 2), {"DE": series([2, 3], [0, 1])}))
+        self.assertEqual(os.path.getmtime(os.path.join(self.path, "cases.npy")), modified)
+        # a corrected value is written
+        self.assertTrue(store.update(days("2021-01-02", 2), {"DE": series([2, 4], [0, 1])}))
+
+    def test_mismatched_files_are_discarded(self):
+        store = HistoryStore(self.path)
+        store.update(days("2021-01-01", 3), {"DE": series([1, 2, 3], [0, 0, 1])})
+        # as if a save was interrupted after replacing the dates
+        np.save(os.path.join(self.path, "dates.npy"), days("2021-01-01", 4))
+        with self.assertLogs("history", level="WARNING"):
+            store = HistoryStore(self.path)
+        self.assertIsNone(store.last_date)
+        self.assertNotIn("DE", store)
+
+
+class FakeApi(CovidApi):
+    """A CovidApi answering requests from a dict of responses by path instead of the network."""
+
+    def __init__(self, responses, **kwargs):
+        self.responses = responses
+        super().__init__(**kwargs)
+
+    def _fetch(self, path, params=None):
+        return self.responses.get(path)
+
+
+def historical(country, cases):
+    timeline = {"1/{}/21".format(i + 1): value for i, value in enumerate(cases)}
+    return {"country": country, "timeline": {"cases": timeline, "deaths": dict.fromkeys(timeline, 0)}}
+
+
+class RefreshHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = HistoryStore(directory.name)
+
+    def test_provinces_are_summed_per_country(self):
+        api = FakeApi({
+            "countries": [{"country": "France", "countryInfo": {"iso2": "FR", "iso3": "FRA"}}],
+            "historical": [historical("France", [1, 2]), historical("France", [10, 20]), historical("Atlantis", [5, 5])],
+        }, history=self.store)
+        self.assertTrue(api.refresh_history())
+        _, cases, _ = self.store.series("FR", 2)
+        np.testing.assert_array_equal(cases, [11, 22])
+
+    def test_no_known_countries(self):
+        # e.g. on a cold start, if the countries request failed
+        api = FakeApi({"historical": [historical("France", [1, 2])]}, history=self.store)
+        self.assertFalse(api.refresh_history())
+        self.assertIsNone(self.store.last_date)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import pickle
+import tempfile
+import unittest
+
+from persistence import SqlitePersistence
+
+
+class SqlitePersistenceTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filename = os.path.join(directory.name, "database.sqlite")
+        self.legacy_filename = os.path.join(directory.name, "database.pkl")
+
+    def open(self, **kwargs):
+        persistence = SqlitePersistence(self.filename, **kwargs)
+        self.addCleanup(persistence._connection.close)
+        return persistence
+
+    def test_round_trip(self):
+        persistence = self.open()
+        persistence.update_user_data(1, {"first_acc": 1.5})
+        persistence.update_chat_data(-2, {"country": "DE"})
+        persistence.update_bot_data({"subscribers": [-2]})
+        persistence.update_conversation("setcountry", (3, 4), 1)
+        persistence.flush()
+        persistence = self.open()
+        self.assertEqual(persistence.get_user_data()[1], {"first_acc": 1.5})
+        self.assertEqual(persistence.get_chat_data()[-2], {"country": "DE"})
+        self.assertEqual(persistence.get_bot_data(), {"subscribers": [-2]})
+        self.assertEqual(persistence.get_conversations("setcountry"), {(3, 4): 1})
+
+    def test_ended_conversations_are_deleted(self):
+        persistence = self.open()
+        persistence.update_conversation("setcountry", (3, 4), 1)
+        persistence.flush()
+        persistence.update_conversation("setcountry", (3, 4), None)
+        persistence.flush()
+        self.assertEqual(self.open().get_conversations("setcountry"), {})
+
+    def test_only_changed_records_are_dirty(self):
+        persistence = self.open()
+        for i in range(10):
+            persistence.update_user_data(i, {"count": i})
+            persistence.update_chat_data(i, {"lang": "en"})
+        persistence.flush()
+        user_data, chat_data = persistence.get_user_data(), persistence.get_chat_data()
+        for i in range(10):
+            persistence.update_user_data(i, user_data[i])
+            persistence.update_chat_data(i, chat_data[i])
+        persistence.update_bot_data(persistence.get_bot_data())
+        self.assertEqual(persistence._dirty_users, set())
+        self.assertEqual(persistence._dirty_chats, set())
+        self.assertFalse(persistence._dirty_bot_data)
+        user_data[3]["count"] += 1
+        persistence.update_user_data(3, user_data[3])
+        self.assertEqual(persistence._dirty_users, {3})
+
+    def test_migration(self):
+        legacy = {
+            "user_data": {1: {"count": 3}},
+            "chat_data": {-2: {"country": "FR"}},
+            "bot_data": {"subscribers": [-2]},
+            "conversations": {"setcountry": {(3, 4): 1}},
+        }
+        with open(self.legacy_filename, "wb") as f:
+            pickle.dump(legacy, f)
+        self.open(migrate_from=self.legacy_filename)
+        persistence = self.open()
+        self.assertEqual(persistence.get_user_data()[1], {"count": 3})
+        self.assertEqual(persistence.get_chat_data()[-2], {"country": "FR"})
+        self.assertEqual(persistence.get_bot_data(), {"subscribers": [-2]})
+        self.assertEqual(persistence.get_conversations("setcountry"), {(3, 4): 1})
+
+    def test_no_migration_into_existing_database(self):
+        persistence = self.open()
+        persistence.update_user_data(1, {"count": 1})
+        persistence.flush()
+        with open(self.legacy_filename, "wb") as f:
+            pickle.dump({"user_data": {1: {"count": 3}}}, f)
+        persistence = self.open(migrate_from=self.legacy_filename)
+        self.assertEqual(persistence.get_user_data()[1], {"count": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
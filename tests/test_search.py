@@ -0,0 +1,60 @@
+import unittest
+
+from search import NameResolver, PrefixIndex, normalize
+
+
+class PrefixIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = PrefixIndex(["Germany", "Georgia", "Ghana", "germany", "Greece", "Austria"])
+
+    def test_search(self):
+        self.assertEqual(self.index.search("ge"), ["georgia", "germany"])
+        self.assertEqual(self.index.search("G"), ["georgia", "germany", "ghana", "greece"])
+        self.assertEqual(self.index.search("x"), [])
+
+    def test_limit(self):
+        self.assertEqual(self.index.search("g", limit=2), ["georgia", "germany"])
+        self.assertEqual(self.index.search("g", limit=0), [])
+
+    def test_duplicates_are_removed(self):
+        self.assertEqual(len(self.index), 5)
+
+
+class NameResolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.resolver = NameResolver({
+            "Germany": "DE", "Deutschland": "DE", "España": "ES", "Côte d'Ivoire": "CI", "Iran": "IR", "Iraq": "IQ",
+            "United States": "US",
+        })
+
+    def test_normalize(self):
+        self.assertEqual(normalize("  Côte d'Ivoire "), "cote d ivoire")
+        self.assertEqual(normalize("ESPAÑA"), "espana")
+
+    def test_exact_match(self):
+        self.assertEqual(self.resolver.resolve("germany"), "DE")
+        self.assertEqual(self.resolver.resolve("Espana"), "ES")
+        self.assertEqual(self.resolver.resolve("cote d'ivoire"), "CI")
+
+    def test_typos(self):
+        self.assertEqual(self.resolver.resolve("germnay"), "DE")
+        self.assertEqual(self.resolver.resolve("deutchland"), "DE")
+        self.assertEqual(self.resolver.resolve("united stats"), "US")
+
+    def test_without_fuzzy(self):
+        self.assertIsNone(self.resolver.resolve("germnay", fuzzy=False))
+        self.assertEqual(self.resolver.resolve("GERMANY", fuzzy=False), "DE")
+
+    def test_short_names_must_match_exactly(self):
+        self.assertIsNone(self.resolver.resolve("irab"))
+        self.assertIsNone(self.resolver.resolve("xyz"))
+
+    def test_unrelated_names(self):
+        self.assertIsNone(self.resolver.resolve("atlantis"))
+        self.assertIsNone(self.resolver.resolve(""))
+
+
+if __name__ == "__main__":
+    unittest.main()
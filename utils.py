@@ -1,6 +1,11 @@
 from datetime import datetime
 import re
 
+from activity import ActivityTracker
+
+# collects the activity of all users, which is aggregated periodically by activity.flush()
+activity = ActivityTracker()
+
 def lang(update):
     if update.message:
         return update.message.from_user.language_code
@@ -12,15 +17,8 @@ def lang(update):
 def handler_decorator(handler):
     def wrapper(update, context, *args):
         ret = handler(update, context, *args)
-        time = datetime.now().timestamp()
-        if not 'first_acc' in context.user_data:
-            context.user_data['first_acc'] = time
-        context.user_data['last_acc'] = time
-        if not 'count' in context.user_data:
-            context.user_data['count'] = 1
-        else:
-            context.user_data['count'] += 1
-        context.dispatcher.persistence.flush()
+        if update.effective_user:
+            activity.record(update.effective_user.id, handler.__name__, datetime.now().timestamp())
         return ret
     return wrapper
 
@@ -2,21 +2,54 @@ from SPARQLWrapper import SPARQLWrapper, JSON
 import requests
 import logging
 import sys
+import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from threading import Lock
+
+from circuit import CircuitBreaker, CircuitOpenError
 
 logger = logging.getLogger(__name__)
 
 # set a custom user agent to reduce the chance of getting blocked
 user_agent = "coronapandemicbot Python/{}.{}".format(sys.version_info[0], sys.version_info[1])
 sparql = SPARQLWrapper("https://query.wikidata.org/sparql", agent=user_agent)
+sparql_lock = Lock()
+
+# stop querying Wikidata and Wikimedia Commons for a while after repeated failures
+sparql_circuit = CircuitBreaker("wikidata")
+commons_circuit = CircuitBreaker("commons")
 
 WORLD_MAP="https://upload.wikimedia.org/wikipedia/commons/thumb/3/3b/COVID-19_Outbreak_World_Map_per_Capita.svg/500px-COVID-19_Outbreak_World_Map_per_Capita.svg.png"
 
-cached = {}
+# resolved map urls by country code with the time they were resolved
+maps = {}
+maps_file = None
+# maps are resolved again after one week
+MAP_TTL = 7*24*60*60
+
+# languages of the country names used to resolve place names
+LABEL_LANGUAGES = ["en", "de", "es", "fr", "it", "pt", "nl", "pl", "tr", "ru", "uk"]
+
+def _head(url):
+    r = requests.head(url, allow_redirects=True, timeout=30)
+    # server errors count as failures of Commons
+    if r.status_code >= 500:
+        r.raise_for_status()
+    return r
 
 # We cannot send an svg as picture in Telegram. So, for svgs, find a matching png.
 def _check_path(url):
-    r = requests.get(url)
+    try:
+        r = commons_circuit.call(_head, url)
+    except (requests.RequestException, CircuitOpenError) as ex:
+        logger.info(ex)
+        return None
+    if not r.ok:
+        logger.info("Map {} is not available: {}".format(url, r.status_code))
+        return None
     path = r.url
     if path.endswith(".svg"):
         path = path.replace("/commons/", "/commons/thumb/")
@@ -25,6 +58,22 @@ def _check_path(url):
     else:
         return path
 
+# run a query, returning its result bindings or None if it failed
+def _query(query):
+    with sparql_lock:
+        sparql.setQuery(query)
+        sparql.setReturnFormat(JSON)
+        try:
+            results = sparql_circuit.call(lambda: sparql.query().convert())['results']['bindings']
+            logger.debug(results)
+            return results
+        except CircuitOpenError:
+            logger.info("Skipping query, Wikidata is unavailable.")
+            return None
+        except Exception as ex:
+            logger.info(ex)
+            return None
+
 # add a timestamp parameter to every image link to avoid long caching by Telegram servers
 def _add_timestamp(url):
     timestamp = datetime.utcnow().strftime("%Y%m%d%H")
@@ -34,35 +83,80 @@ def cases_world_map():
     return _add_timestamp(WORLD_MAP)
 
 def cases_country_map(country_code):
-    country_code = country_code.upper()
-    if country_code in cached:
-        return _add_timestamp(cached[country_code])
-    sparql.setQuery("""
+    # never blocks on Wikidata, maps are resolved in the background by update_maps()
+    entry = maps.get(country_code.upper())
+    return _add_timestamp(entry['url']) if entry and entry['url'] else None
+
+def load_maps(path):
+    """Loads resolved map urls from a file, which is also used to persist future updates."""
+    global maps, maps_file
+    maps_file = path
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            maps = json.load(f)
+
+def outdated_maps(country_codes):
+    now = time.time()
+    return [code for code in country_codes if code not in maps or maps[code]['time'] + MAP_TTL < now]
+
+def update_maps(country_codes):
+    """Resolves the map urls of all given countries with one query and checks their paths concurrently."""
+    global maps
+    values = " ".join('"{}"'.format(code.upper()) for code in country_codes)
+    results = _query("""
         PREFIX pq: <http://www.wikidata.org/prop/qualifier/>
         PREFIX p: <http://www.wikidata.org/prop/>
         PREFIX wdt: <http://www.wikidata.org/prop/direct/>
         PREFIX wd: <http://www.wikidata.org/entity/>
-        SELECT ?img
-        WHERE 
+        SELECT ?iso2 ?img
+        WHERE
         {{
+            VALUES ?iso2 {{ {0} }}
             ?page p:P31 ?prop.
             ?prop pq:P642 wd:Q84263196.
             ?page wdt:P276 ?country.
             ?country wdt:P297 ?iso2.
-            ?country wdt:P298 ?iso3.
             ?page wdt:P1846 ?img.
-            FILTER(?iso2 = "{0}" || ?iso3 = "{0}")
-        }}""".format(country_code))
-    sparql.setReturnFormat(JSON)
-    try:
-        results = sparql.query().convert()['results']['bindings']
-        logger.debug(results)
-        if len(results) > 0:
-            path = _check_path(results[0]['img']['value'])
-            cached[country_code] = path
-            return _add_timestamp(path)
-        else:
-            return None
-    except Exception as ex:
-        logger.info(ex)
+        }}""".format(values))
+    if results is None:
+        return False
+    images = {}
+    for result in results:
+        images.setdefault(result['iso2']['value'], result['img']['value'])
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        paths = dict(zip(images, executor.map(_check_path, images.values())))
+    now = time.time()
+    updated = dict(maps)
+    for code in country_codes:
+        code = code.upper()
+        if paths.get(code):
+            updated[code] = {'url': paths[code], 'time': now}
+        elif code not in images:
+            # remember countries without a map, so they are not queried again before the ttl expired
+            updated[code] = {'url': None, 'time': now}
+    maps = updated
+    if maps_file:
+        with open(maps_file + ".tmp", 'w') as f:
+            json.dump(updated, f)
+        os.replace(maps_file + ".tmp", maps_file)
+    return True
+
+def country_labels(languages=LABEL_LANGUAGES):
+    """Returns the names and alternative names of all countries in the given languages, keyed by ISO2 code."""
+    results = _query("""
+        PREFIX wdt: <http://www.wikidata.org/prop/direct/>
+        PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+        PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+        SELECT ?iso2 ?label
+        WHERE
+        {{
+            ?country wdt:P297 ?iso2.
+            {{ ?country rdfs:label ?label. }} UNION {{ ?country skos:altLabel ?label. }}
+            FILTER(LANG(?label) IN ({0}))
+        }}""".format(", ".join('"{}"'.format(language) for language in languages)))
+    if results is None:
         return None
+    labels = {}
+    for result in results:
+        labels.setdefault(result['iso2']['value'], []).append(result['label']['value'])
+    return labels